@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of MFBN on synthetic k-partite networks
+
+Copyright (C) 2020 Alan Valejo <alanvalejo@gmail.com> All rights reserved
+
+This program comes with ABSOLUTELY NO WARRANTY. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS
+WITH YOU.
+
+Owner or contributors are not liable for any direct, indirect, incidental, special, exemplary, or consequential
+damages, (such as loss of data or profits, and others) arising in any way out of the use of this software,
+even if advised of the possibility of such damage.
+
+This program is free software and distributed in the hope that it will be useful: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with this program. If not,
+see http://www.gnu.org/licenses/.
+
+Giving credit to the author by citing the papers.
+"""
+
+import sys
+import os
+import inspect
+import json
+import logging
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import argparse
+import numpy
+
+from datetime import datetime
+
+from models.mgraph import MGraph
+from models.coarsening import Coarsening
+from models.similarity import Similarity
+from models.hierarchy import HierarchyWriter
+from models import synthetic
+import models.args as args
+import mfbn
+
+__maintainer__ = 'Alan Valejo'
+__email__ = 'alanvalejo@gmail.com'
+__author__ = 'Alan Valejo'
+__credits__ = ['Alan Valejo']
+__homepage__ = 'https://www.alanvalejo.com.br'
+__license__ = 'GNU.GPL.v3'
+__docformat__ = 'markdown en'
+__version__ = '0.1'
+__date__ = '2020-05-05'
+
+
+def measure(case, repeat=1, memory=False):
+    """
+    Fastest wall time of repeat runs of case and, with memory, the peak of
+    the memory allocated by a separate traced run (tracing slows it down)
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case()
+        times.append(time.perf_counter() - start)
+    result = {'time': min(times)}
+    if memory:
+        tracemalloc.start()
+        case()
+        result['peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def similarity_case(graph, measure, vertices):
+    def case():
+        graph['adjlist'] = None
+        Similarity(graph, graph.adjacency_sets()).two_hops(vertices, measure)
+    return case
+
+
+def matching_case(graph, matching, similarity, threads=1):
+    def case():
+        graph['adjlist'] = None
+        layers = graph['layers']
+        Coarsening(
+            graph, matching=[matching] * layers, similarity=[similarity] * layers, max_levels=[1] * layers,
+            reverse=['true'] * layers, threads=threads, parallel_layer=threads > 1).run()
+    return case
+
+
+def save_case(source_graph, coarsened_graph, directory):
+    options = argparse.Namespace(
+        output=directory + '/benchmark', save_ncol=True, save_source=True, save_membership=True,
+        save_predecessor=True, save_successor=True, save_weight=True, save_gml=True)
+
+    def case():
+        mfbn.save_level(options, source_graph, 1, coarsened_graph)
+        writer = HierarchyWriter(options.output + '.mfbn')
+        writer.add(1, coarsened_graph['level'], coarsened_graph)
+        writer.close()
+    return case
+
+
+def cases(options, filename, vertices, directory):
+    """ Benchmark cases of a synthetic network, as (name, case) pairs """
+
+    graph = MGraph()
+    graph.load(filename, vertices)
+    yield 'load', lambda: MGraph().load(filename, vertices)
+
+    sample = graph['vertices_by_type'][0][:options.sample]
+    for measure in options.similarity:
+        yield 'similarity.' + measure, similarity_case(graph, measure, sample)
+
+    # Each matching with one thread and, given more cpus, with the threads
+    # that split the layers (see parallel_layer)
+    threads = options.threads or os.cpu_count()
+    for matching in options.matching:
+        similarity = 'hops_common_neighbors' if matching == 'mlpb' else options.matching_similarity
+        yield 'matching.' + matching, matching_case(graph, matching, similarity)
+        if threads > 1:
+            yield 'matching.%s.threads-%d' % (matching, threads), matching_case(graph, matching, similarity, threads)
+
+    # Pairs of consecutive vertices of each layer
+    pairs = numpy.concatenate([
+        start + numpy.arange(count) // 2 * 2 for start, count in zip(numpy.cumsum([0] + vertices[:-1]), vertices)])
+    yield 'contract', lambda: graph.contract(pairs)
+
+    coarsened_graph = graph.contract(pairs)
+    coarsened_graph['level'] = [1] * graph['layers']
+    yield 'save', save_case(graph, coarsened_graph, directory)
+
+
+def backend_cases(options, filename, vertices):
+    """
+    Adjacency backends of Similarity on a network, as (name, case) pairs:
+    building the sets or bitsets, scoring the two-hop pairs of the first
+    layer in batch and one pair at a time
+    """
+
+    graph = MGraph()
+    graph.load(filename, vertices)
+    rows, cols, _ = Similarity(graph).two_hops(graph['vertices_by_type'][0])
+    for backend in options.backends:
+        similarity = Similarity(graph, backend=backend)
+
+        def build(similarity=similarity):
+            graph['adjlist'], similarity.adjlist, similarity.bits = None, None, None
+            similarity.bitsets() if backend == 'bitsets' else similarity.neighbor_sets()
+        yield 'build.' + backend, build
+
+        for measure in options.backend_similarity:
+            yield 'pairs.%s.%s' % (measure, backend), (
+                lambda similarity=similarity, measure=measure: similarity.score_pairs(rows, cols, measure))
+            function = getattr(similarity, measure)
+            yield 'pairwise.%s.%s' % (measure, backend), (
+                lambda function=function: [function(i, j) for i, j in zip(rows.tolist(), cols.tolist())])
+
+
+def engine_checks(options, filename, vertices):
+    """
+    Hierarchies of a network by gmb and rgmb with each checked similarity,
+    built by the batch engines, by the pairwise measures and, for rgmb, by
+    two workers that split each layer (given two cpus), as (name, levels,
+    differing levels) triples: their memberships must be the same
+    """
+
+    for matching in ['gmb', 'rgmb']:
+        for similarity in options.check_similarity:
+            runs = [dict(similarity_engine='batch'), dict(similarity_engine='pairwise')]
+            if matching == 'rgmb' and os.cpu_count() > 1:
+                runs.append(dict(threads=2, parallel_layer=True))
+            hierarchies = []
+            for run in runs:
+                graph = MGraph()
+                graph.load(filename, vertices)
+                layers = graph['layers']
+                coarsening = Coarsening(
+                    graph, matching=[matching] * layers, similarity=[similarity] * layers,
+                    max_levels=[100] * layers, gmv=[2] * layers, reverse=['true'] * layers, **run)
+                coarsening.run()
+                hierarchies.append([level.membership() for level in coarsening.hierarchy_graphs])
+            batch = hierarchies[0]
+            differing = sum(abs(len(batch) - len(other)) + sum(
+                not numpy.array_equal(first, second) for first, second in zip(batch, other))
+                for other in hierarchies[1:])
+            yield matching + '.' + similarity, len(batch), differing
+
+
+def incremental_checks(options, filename, vertices):
+    """
+    Hierarchies of a network by mlpb with each seed priority and checked upper
+    bound, built by full and by incremental sweeps, as (name, levels, differing
+    levels) triples: their memberships must be the same
+    """
+
+    for seed_priority in ['degree', 'random']:
+        for upper_bound in options.check_upper_bound:
+            hierarchies = []
+            for incremental in [False, True]:
+                random.seed(options.seed)
+                graph = MGraph()
+                graph.load(filename, vertices)
+                layers = graph['layers']
+                coarsening = Coarsening(
+                    graph, matching=['mlpb'] * layers, seed_priority=[seed_priority] * layers,
+                    upper_bound=[upper_bound] * layers, max_levels=[100] * layers, gmv=[2] * layers,
+                    reverse=['true'] * layers, incremental=incremental)
+                coarsening.run()
+                hierarchies.append([level.membership() for level in coarsening.hierarchy_graphs])
+            full, other = hierarchies
+            differing = abs(len(full) - len(other)) + sum(
+                not numpy.array_equal(first, second) for first, second in zip(full, other))
+            yield 'mlpb.%s.%s' % (seed_priority, upper_bound), len(full), differing
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(history):
+    """ Latest former result of each (case, edges) """
+
+    previous = {}
+    for run in history:
+        for result in run['results']:
+            previous[(result['case'], result['edges'])] = result
+    return previous
+
+
+def main():
+    """
+    Generate the synthetic networks, run every case on each of them and
+    append the results to the JSON history, reporting the time ratio to the
+    latest former result of the same case and size and, for the matchings
+    with threads, the speedup over the same matching with one thread.
+    """
+
+    current_path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+    parser = args.setup_parser(current_path + '/args/benchmark.json')
+    options = parser.parse_args()
+    args.update_json(options)
+
+    logging.basicConfig(level=getattr(logging, options.log_level.upper()),
+                        format='%(levelname)s %(name)s: %(message)s')
+
+    history = []
+    if os.path.isfile(options.history):
+        with open(options.history) as f:
+            history = json.load(f)
+    previous = previous_results(history)
+
+    commit = git_commit()
+    run = {
+        'label': options.label or commit, 'commit': commit, 'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'numpy': numpy.__version__, 'cpus': os.cpu_count(),
+        'options': {key: value for key, value in vars(options).items() if key not in ['conf', 'history', 'label']},
+        'results': []
+    }
+
+    print('{:>10} {:>34} {:>12} {:>12} {:>10} {:>8}'.format(
+        'Edges', 'Case', 'Time [s]', 'Peak [MB]', 'Ratio', 'Speedup'))
+    with tempfile.TemporaryDirectory() as directory:
+        for edges in options.edges:
+            per_layer = max(options.communities, int(2 * edges / (options.degree * options.layers)))
+            vertices = [per_layer] * options.layers
+            network, weights, _ = synthetic.kpartite(
+                vertices, edges, communities=options.communities, mixing=options.mixing,
+                exponent=options.exponent, seed=options.seed)
+            filename = directory + '/synthetic-' + str(edges) + '.ncol'
+            synthetic.write_ncol(filename, network, weights)
+
+            times = {}
+            for name, case in cases(options, filename, vertices, directory):
+                result = dict(case=name, edges=edges, ecount=len(network), vertices=vertices,
+                              **measure(case, options.repeat, options.memory))
+                serial, _, threads = name.partition('.threads-')
+                if threads and serial in times and result['time'] > 0:
+                    result.update(threads=int(threads), speedup=times[serial] / result['time'])
+                times[name] = result['time']
+                run['results'].append(result)
+                former = previous.get((name, edges))
+                print('{:>10} {:>34} {:>12.4f} {:>12} {:>10} {:>8}'.format(
+                    edges, name, result['time'],
+                    '%.1f' % (result['peak'] / 2 ** 20) if 'peak' in result else '-',
+                    '%.2f' % (result['time'] / former['time']) if former and former['time'] > 0 else '-',
+                    '%.2f' % result['speedup'] if 'speedup' in result else '-'), flush=True)
+
+    # Adjacency backends and similarity engines on the BNOC networks
+    failures = 0
+    bnoc = options.bnoc
+    if bnoc and not os.path.isabs(bnoc):
+        bnoc = os.path.join(current_path, bnoc)
+    for name in sorted(os.listdir(bnoc)) if bnoc and os.path.isdir(bnoc) else []:
+        filename = os.path.join(bnoc, name, name + '.ncol')
+        if not os.path.isfile(filename):
+            continue
+        with open(os.path.join(bnoc, name, name + '-inf.json')) as f:
+            vertices = json.load(f)['vertices']
+        for case_name, case in backend_cases(options, filename, vertices):
+            case_name = name + '/' + case_name
+            result = dict(case=case_name, edges=None, vertices=vertices,
+                          **measure(case, options.repeat, options.memory))
+            run['results'].append(result)
+            former = previous.get((case_name, None))
+            print('{:>10} {:>34} {:>12.4f} {:>12} {:>10} {:>8}'.format(
+                '-', case_name, result['time'],
+                '%.1f' % (result['peak'] / 2 ** 20) if 'peak' in result else '-',
+                '%.2f' % (result['time'] / former['time']) if former and former['time'] > 0 else '-', '-'), flush=True)
+        for prefix, checks in [('engines', engine_checks), ('incremental', incremental_checks)]:
+            for case_name, levels, differing in checks(options, filename, vertices):
+                case_name = name + '/' + prefix + '.' + case_name
+                run['results'].append(dict(case=case_name, edges=None, vertices=vertices, levels=levels,
+                                           differing=differing))
+                failures += differing > 0
+                print('{:>10} {:>34} {:>12} {:>12} {:>10} {:>8}'.format(
+                    '-', case_name, '%d levels' % levels, '-', '%d differ' % differing if differing else 'same', '-'),
+                    flush=True)
+
+    history.append(run)
+    directory = os.path.dirname(os.path.abspath(options.history))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(options.history, 'w+') as f:
+        json.dump(history, f, indent=4)
+
+    if failures:
+        print('Hierarchies differ in %d checks' % failures)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -59,14 +59,19 @@ For now, you can use this version without guarantee of the results.
 """
 
 import sys
-import numpy
 import os
 import inspect
 import json
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
 
 from models.mgraph import MGraph
+from models.external import Spill
 from models.coarsening import Coarsening
 import models.args as args
+import models.export as export
+from models.hierarchy import HierarchyWriter
 
 from models.timing import Timing
 
@@ -81,6 +86,37 @@ __version__ = '0.1.0'
 __date__ = '2020-04-25'
 
 
+def save_level(options, source_graph, index, coarsened_graph):
+    """
+    Write the files of one level of the hierarchy: memberships are composed
+    from the successor arrays and the text files are formatted and written
+    in large chunks.
+    """
+
+    output = options.output + '-' + str(index)
+
+    if options.save_ncol:
+        coarsened_graph.write(output + '.ncol', format='ncol')
+
+    if options.save_source:
+        export.write_rows(output + '.source', *coarsened_graph.source_arrays())
+
+    if options.save_membership:
+        export.write_values(output + '.membership', coarsened_graph.membership())
+
+    if options.save_predecessor:
+        export.write_rows(output + '.predecessor', coarsened_graph.predecessor_ptr, coarsened_graph.predecessor)
+
+    if options.save_successor:
+        export.write_values(output + '.successor', coarsened_graph.successor)
+
+    if options.save_weight:
+        export.write_values(output + '.weight', coarsened_graph.weight)
+
+    if options.save_gml:
+        export.write_gml(output + '.gml', coarsened_graph)
+
+
 def main():
     """
     Main entry point for the application when run from the command line.
@@ -99,6 +135,10 @@ def main():
         args.update_json(options)
         args.check_output(options)
 
+        # Silent by default: summaries are only formatted when enabled
+        logging.basicConfig(level=getattr(logging, options.log_level.upper()),
+                            format='%(levelname)s %(name)s: %(message)s')
+
         if options.input and options.vertices is None:
             print('Vertices are required when input is given.')
             sys.exit(1)
@@ -106,8 +146,9 @@ def main():
     # Load bipartite graph
     with timing.timeit_context_add('Load graph'):
 
+        spill = Spill(options.out_of_core, options.in_memory_edges) if options.out_of_core else None
         source_graph = MGraph()
-        source_graph.load(options.input, options.vertices)
+        source_graph.load(options.input, options.vertices, cache=options.cache, spill=spill)
 
     # Coarsening
     with timing.timeit_context_add('Coarsening'):
@@ -117,23 +158,48 @@ def main():
             matching=options.matching, similarity=options.similarity, itr=options.itr,
             upper_bound=options.upper_bound, gmv=options.gmv, max_hops=options.max_hops,
             layers_to_coarse=options.layers_to_coarse, tolerance=options.tolerance,
-            reverse=options.reverse, seed_priority=options.seed_priority, threads=options.threads
+            reverse=options.reverse, seed_priority=options.seed_priority, threads=options.threads,
+            parallel_layer=options.parallel_layer, incremental=options.incremental, cache_memory=options.cache_memory,
+            nmf_components=options.nmf_components, nmf_fit=options.nmf_fit, nmf_memory=options.nmf_memory,
+            lsh_top_k=options.lsh_top_k, lsh_threshold=options.lsh_threshold, lsh_permutations=options.lsh_permutations,
+            hub_degree=options.hub_degree, hub_percentile=options.hub_percentile, hub_mode=options.hub_mode,
+            hub_sample=options.hub_sample, adjacency_backend=options.adjacency_backend,
+            similarity_engine=options.similarity_engine
         )
 
-        coarsening = Coarsening(source_graph, **kwargs)
+        # Levels are saved by a thread pool while the next ones are computed
+        saving = ThreadPoolExecutor(max_workers=options.threads)
+        futures = []
+        writer = HierarchyWriter(options.output + '.mfbn') if options.save_mfbn else None
+
+        def on_level(index, level, coarsened_graph):
+            if index == 1 or options.save_hierarchy:
+                futures.append(saving.submit(save_level, options, source_graph, index, coarsened_graph))
+                if writer is not None:
+                    futures.append(saving.submit(writer.add, index, level, coarsened_graph))
+
+        coarsening = Coarsening(source_graph, on_level=on_level, timing=timing, **kwargs)
         coarsening.run()
 
     # Save
     with timing.timeit_context_add('Save'):
 
         output = options.output
+
+        # Files written by the saving threads in the meantime
+        for future in futures:
+            future.result()
+        saving.shutdown()
+        if writer is not None:
+            writer.close()
+
         for index, obj in enumerate(zip(coarsening.hierarchy_levels, coarsening.hierarchy_graphs)):
             level, coarsened_graph = obj
             index += 1
 
             if options.save_conf or options.show_conf:
                 d = {
-                    'source_input': options.input, 'source_vertices': source_graph['vertices'], 'source_vcount': source_graph.vcount(), 'source_ecount': source_graph.ecount(), 'coarsened_ecount': coarsened_graph.ecount(), 'coarsened_vcount': coarsened_graph.vcount(), 'coarsened_vertices': coarsened_graph['vertices'], 'achieved_levels': coarsened_graph['level'], 'reduction_factor': options.reduction_factor, 'max_levels': options.max_levels, 'similarity': options.similarity, 'matching': options.matching, 'upper_bound': options.upper_bound, 'gmv': options.gmv, 'max_hops': options.max_hops, 'layers_to_coarse': options.layers_to_coarse, 'itr': options.itr, 'level': level
+                    'source_input': options.input, 'source_vertices': source_graph['vertices'], 'source_vcount': source_graph.vcount(), 'source_ecount': source_graph.ecount(), 'coarsened_ecount': coarsened_graph.ecount(), 'coarsened_vcount': coarsened_graph.vcount(), 'coarsened_vertices': coarsened_graph['vertices'], 'achieved_levels': coarsening.achieved_levels, 'reduction_factor': options.reduction_factor, 'max_levels': options.max_levels, 'similarity': options.similarity, 'matching': options.matching, 'upper_bound': options.upper_bound, 'gmv': options.gmv, 'max_hops': options.max_hops, 'layers_to_coarse': options.layers_to_coarse, 'itr': options.itr, 'level': level
                 }
 
             if options.save_conf:
@@ -143,67 +209,20 @@ def main():
             if options.show_conf:
                 print(json.dumps(d, indent=4))
 
-            if options.save_ncol:
-                coarsened_graph.write(
-                    output + '-' + str(index) + '.ncol', format='ncol')
-
-            if options.save_source:
-                with open(output + '-' + str(index) + '.source', 'w+') as f:
-                    for v in coarsened_graph.vs():
-                        f.write(' '.join(map(str, v['source'])) + '\n')
-
-            if options.save_membership:
-                membership = [0] * sum(source_graph['vertices'])
-                for v in coarsened_graph.vs():
-                    for source in v['source']:
-                        membership[source] = v.index
-                numpy.savetxt(output + '-' + str(index) +
-                              '.membership', membership, fmt='%d')
-
-            if options.save_predecessor:
-                with open(output + '-' + str(index) + '.predecessor', 'w+') as f:
-                    for v in coarsened_graph.vs():
-                        f.write(' '.join(map(str, v['predecessor'])) + '\n')
-
-            if options.save_successor:
-                numpy.savetxt(output + '-' + str(index) + '.successor',
-                              coarsened_graph.vs['successor'], fmt='%d')
-
-            if options.save_weight:
-                numpy.savetxt(output + '-' + str(index) + '.weight',
-                              coarsened_graph.vs['weight'], fmt='%d')
-
-            if options.save_gml:
-                del coarsened_graph['adjlist']
-                del coarsened_graph['similarity']
-                coarsened_graph['layers'] = str(coarsened_graph['layers'])
-                coarsened_graph['vertices'] = ','.join(
-                    map(str, coarsened_graph['vertices']))
-                coarsened_graph['level'] = ','.join(
-                    map(str, coarsened_graph['level']))
-                coarsened_graph.vs['name'] = map(
-                    str, range(0, coarsened_graph.vcount()))
-                coarsened_graph.vs['type'] = map(
-                    str, coarsened_graph.vs['type'])
-                coarsened_graph.vs['weight'] = map(
-                    str, coarsened_graph.vs['weight'])
-                coarsened_graph.vs['successor'] = map(
-                    str, coarsened_graph.vs['successor'])
-                for v in coarsened_graph.vs():
-                    v['source'] = ','.join(map(str, v['source']))
-                    v['predecessor'] = ','.join(map(str, v['predecessor']))
-                coarsened_graph.write(
-                    output + '-' + str(index) + '.gml', format='gml')
-
             if not options.save_hierarchy:
                 break
 
+        if spill is not None:
+            spill.close()
+
     if options.show_timing:
         timing.print_tabular()
     if options.save_timing_csv:
         timing.save_csv(output + '-timing.csv')
     if options.save_timing_json:
         timing.save_json(output + '-timing.json')
+    if options.save_timing_trace:
+        timing.save_trace(output + '-timing-trace.json')
 
 
 if __name__ == "__main__":
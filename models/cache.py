@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Bounded caches
+
+Copyright (C) 2020 Alan Valejo <alanvalejo@gmail.com> All rights reserved
+
+This program comes with ABSOLUTELY NO WARRANTY. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS
+WITH YOU.
+
+Owner or contributors are not liable for any direct, indirect, incidental, special, exemplary, or consequential
+damages, (such as loss of data or profits, and others) arising in any way out of the use of this software,
+even if advised of the possibility of such damage.
+
+This program is free software and distributed in the hope that it will be useful: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with this program. If not,
+see http://www.gnu.org/licenses/.
+
+Giving credit to the author by citing the papers.
+"""
+
+import collections
+import sys
+
+__maintainer__ = 'Alan Valejo'
+__email__ = 'alanvalejo@gmail.com'
+__author__ = 'Alan Valejo'
+__credits__ = ['Alan Valejo']
+__homepage__ = 'https://www.alanvalejo.com.br'
+__license__ = 'GNU.GPL.v3'
+__docformat__ = 'markdown en'
+__version__ = '0.1'
+__date__ = '2020-05-05'
+
+# Returned by get for absent keys, as cached values may be falsy (0.0, [])
+missing = object()
+
+# Bytes of an entry besides its key and value: the slot of the ordered dict
+# and the (value, bytes) pair it holds
+entry_overhead = 160
+
+
+def entry_bytes(key, value):
+    """ Estimated memory of a cache entry: key, value and the items of tuples and lists """
+
+    size = entry_overhead
+    for item in (key, value):
+        size += sys.getsizeof(item)
+        if isinstance(item, (tuple, list)):
+            size += sum(map(sys.getsizeof, item))
+    return size
+
+
+class LRUCache(object):
+    """
+    Mapping that holds at most maxbytes (None: unbounded) of entries, as
+    estimated by entry_bytes, evicting the least recently used ones beyond
+    it. Hits, misses and evictions are counted.
+    """
+
+    def __init__(self, maxbytes=None):
+        self.maxbytes = maxbytes
+        self.data = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, key, value):
+        if key in self.data:
+            self.nbytes -= self.data[key][1]
+        size = entry_bytes(key, value)
+        self.data[key] = (value, size)
+        self.data.move_to_end(key)
+        self.nbytes += size
+        while self.maxbytes is not None and self.nbytes > self.maxbytes:
+            self.nbytes -= self.data.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def get(self, key, default=missing):
+        entry = self.data.get(key, missing)
+        if entry is missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.data.move_to_end(key)
+        return entry[0]
+
+    def clear(self):
+        self.data.clear()
+        self.nbytes = 0
+
+    def __str__(self):
+        return '%d entries (%.1f MB), %d hits, %d misses, %d evictions' % (
+            len(self.data), self.nbytes / 2 ** 20, self.hits, self.misses, self.evictions)
+
+
+class MatchingCache(object):
+    """
+    Caches of mlpb: pair similarities, keyed by (u, v) with u < v, and hop
+    neighborhoods, keyed by vertex. Keys are vertex ids of one level, so the
+    caches are cleared whenever the graph is contracted: the neighborhoods and
+    similarities of the next level differ, even for unmerged vertices whose
+    neighbors were merged. maxbytes (None: unbounded) is split evenly between
+    them.
+    """
+
+    def __init__(self, maxbytes=None):
+        self.similarity = LRUCache(None if maxbytes is None else maxbytes // 2)
+        self.hops = LRUCache(None if maxbytes is None else maxbytes // 2)
+
+    def clear(self):
+        self.similarity.clear()
+        self.hops.clear()
+
+    def __str__(self):
+        return 'similarity cache: %s; hop cache: %s' % (self.similarity, self.hops)
@@ -32,15 +32,85 @@ __docformat__ = 'markdown en'
 __version__ = '0.1'
 __date__ = '2020-05-05'
 
+import os
 import sys
+import time
 import numpy
+import logging
 import multiprocessing as mp
 
 from models.similarity import Similarity
-
-
-def modified_starmap_async(function, kwargs):
-    return function(**kwargs)
+from models.cache import MatchingCache
+from models.shared import SharedGraph, shared_memory, task_graph, worker_pool
+from models.hierarchy import Hierarchy
+from models.timing import Timing, peak_rss
+
+logger = logging.getLogger(__name__)
+
+
+def counters(*similarities):
+    """ Candidate pairs, scored pairs and pruned paths of the given Similarity instances """
+
+    return dict(candidates=sum(similarity.candidates for similarity in similarities),
+                evaluations=sum(similarity.evaluations for similarity in similarities),
+                pruned=sum(similarity.pruned for similarity in similarities))
+
+
+def match_layer(source, layer, matching, similarity, projection, kwargs, expansion):
+    """
+    Matching of one layer. Only the matched vertices and their clusters are
+    returned, so that a worker sends back arrays of the size of the layer,
+    along with the statistics of the task: start and end times, process,
+    counters of Similarity and of the mlpb cache, and peak RSS.
+    expansion: options of the two-hop expansion of Similarity (lsh, hubs)
+    cache_memory: in kwargs, budget of the mlpb cache created for the task
+    """
+
+    start = time.time()
+    graph = task_graph(source)
+    if 'cache_memory' in kwargs:
+        kwargs['cache'] = MatchingCache(kwargs.pop('cache_memory'))
+    cache = kwargs.get('cache')
+    hits = cache.similarity.hits if cache is not None else 0
+    if matching in ['mlpb', 'gmb', 'rgmb']:
+        kwargs['vertices'] = graph['vertices_by_type'][layer]
+    if matching in ['hem', 'lem', 'rm', 'mnmf', 'msvm']:
+        graph['projection'] = getattr(Similarity(graph, **expansion), projection)
+        one_mode_graph = graph.weighted_one_mode_projection(
+            graph['vertices_by_type'][layer], similarity=similarity)
+        matching_function = getattr(one_mode_graph, matching)
+        similarities = [graph['projection'].__self__, one_mode_graph['similarity'].__self__]
+    else:
+        graph['similarity'] = getattr(Similarity(graph, **expansion), similarity)
+        matching_function = getattr(graph, matching)
+        similarities = [graph['similarity'].__self__]
+
+    result = matching_function(**kwargs)
+    vertices = numpy.where(result > -1)[0]
+
+    stats = counters(*similarities)
+    if cache is not None:
+        stats['cache_hits'] = cache.similarity.hits - hits
+    stats.update(start=start, end=time.time(), pid=os.getpid(), peak_rss=peak_rss(),
+                 vertices=len(graph['vertices_by_type'][layer]),
+                 merged=int(numpy.count_nonzero(result[vertices] != vertices)))
+    return vertices, result[vertices], stats
+
+
+def rank_chunk(source, vertices, similarity, expansion):
+    """ rgmb candidates of a chunk of the vertices of a layer, and the counters of Similarity """
+
+    graph = task_graph(source)
+    similarity = getattr(Similarity(graph, **expansion), similarity)
+    return graph.two_hop_candidates(vertices, similarity), counters(similarity.__self__)
+
+
+def hop_chunk(source, vertices, similarity, expansion, hop, low, high):
+    """ mlpb neighborhoods and similarities of a chunk of the vertices of a layer, and the counters of Similarity """
+
+    graph = task_graph(source)
+    similarity = getattr(Similarity(graph, **expansion), similarity)
+    return graph.hop_scores(vertices, similarity, hop, low, high), counters(similarity.__self__)
 
 
 class Coarsening:
@@ -51,7 +121,12 @@ class Coarsening:
             'reduction_factor': [0.5], 'max_levels': [3], 'matching': ['rgmb'],
             'similarity': ['common_neighbors'], 'itr': [10], 'upper_bound': [0.2], 'seed_priority': ['degree'],
             'gmv': [None], 'max_hops': 2, 'layers_to_coarse': [], 'tolerance': [0.01], 'reverse': None, 'projection': 'common_neighbors',
-            'pgrd': [0.50], 'deltap': [0.35], 'deltav': [0.35], 'wmin': [0.0], 'wmax': [1.0], 'threads': 1
+            'pgrd': [0.50], 'deltap': [0.35], 'deltav': [0.35], 'wmin': [0.0], 'wmax': [1.0], 'threads': 1,
+            'parallel_layer': False, 'incremental': False, 'cache_memory': 1024,
+            'nmf_components': 100, 'nmf_fit': 'projection', 'nmf_memory': None,
+            'lsh_top_k': None, 'lsh_threshold': 0.5, 'lsh_permutations': 64,
+            'hub_degree': None, 'hub_percentile': None, 'hub_mode': 'skip', 'hub_sample': None,
+            'adjacency_backend': 'auto', 'similarity_engine': 'batch', 'on_level': None, 'timing': None
         }
 
         self.__dict__.update(prop_defaults)
@@ -60,16 +135,27 @@ class Coarsening:
         self.source_graph = source_graph
         self.hierarchy_graphs = []
         self.hierarchy_levels = []
+        self.published = 0
+        self.achieved_levels = None
+        self.summary = []
+
+        # Options that are not given per layer
+        scalar_props = [
+            'threads', 'max_hops', 'layers_to_coarse', 'parallel_layer', 'incremental', 'cache_memory',
+            'nmf_components', 'nmf_fit', 'nmf_memory', 'lsh_top_k', 'lsh_threshold', 'lsh_permutations',
+            'hub_degree', 'hub_percentile', 'hub_mode', 'hub_sample', 'adjacency_backend', 'similarity_engine',
+            'on_level', 'timing'
+        ]
 
         # Validation of list values
         for prop_name, prop_value in prop_defaults.items():
-            if prop_name not in ['threads', 'max_hops', 'layers_to_coarse'] and len(getattr(self, prop_name)) == 1:
+            if prop_name not in scalar_props and len(getattr(self, prop_name)) == 1:
                 setattr(self, prop_name, [getattr(self, prop_name)[
                         0]] * self.source_graph['layers'])
 
         # Parameters dimension validation
         for prop_name, prop_value in prop_defaults.items():
-            if prop_name not in ['threads', 'projection', 'max_hops', 'layers_to_coarse']:
+            if prop_name not in scalar_props + ['projection']:
                 if self.source_graph['layers'] != len(getattr(self, prop_name)):
                     print('Number of layers and ' +
                           str(prop_name) + ' do not match.')
@@ -101,6 +187,17 @@ class Coarsening:
                 sys.exit(1)
             self.matching[index] = matching
 
+        # Out-of-core validation: only gmb streams the two-hop pairs of a
+        # spilled edge list, the other methods hold them (or the one-mode
+        # projection) in memory
+        if isinstance(self.source_graph.edges, numpy.memmap):
+            layers = self.layers_to_coarse if self.layers_to_coarse else range(self.source_graph['layers'])
+            unsupported = sorted(set(self.matching[layer] for layer in layers) - {'gmb'})
+            if unsupported:
+                print('Matching ' + ', '.join(unsupported) + ' cannot run out of core, only gmb does. '
+                      'Use gmb or raise in_memory_edges above the number of edges.')
+                sys.exit(1)
+
         # Seed priority validation
         valid_seed_priority = ['strength', 'degree', 'random']
         for index, seed_priority in enumerate(self.seed_priority):
@@ -134,6 +231,10 @@ class Coarsening:
                 sys.exit(1)
             self.similarity[index] = similarity
 
+        if self.nmf_fit not in ['projection', 'biadjacency']:
+            print('NMF input ' + self.nmf_fit + ' is invalid.')
+            sys.exit(1)
+
         self.projection = self.projection.lower()
         if self.projection not in valid_similarity:
             print('Projection similarity ' +
@@ -155,58 +256,185 @@ class Coarsening:
                     text += str(layer) + ') does not accept -rf > 0.5.'
                     print(text)
 
-        # Debug edges
-        # How many edges in total?
-        print(f"Total number of edges: {self.source_graph.ecount()}")
-
+        # Startup statistics: since the vertices that have no edges cannot be
+        # clustered, add them to the corresponding GMV (respecting the limit of
+        # the number of vertices)
+        self.statistics = self.source_graph.statistics()
+        logger.info(self.statistics)
         for layer in range(self.source_graph['layers']):
-            vertices_id = self.source_graph['vertices_by_type'][layer]
-
-            # How many vertices with no edges?
-            degree0 = [
-                vertex for vertex in vertices_id if self.source_graph.degree(vertex) == 0]
-            print(
-                F"Layer {layer}: {len(degree0)} vertices with no edges {degree0}")
-            # Since the vertices that have no edges cannot be clustered,
-            # Add it to the corresponding GMV. (Respecting the limit of the number of vertices).
-            self.gmv[layer] = min(
-                self.gmv[layer]+len(degree0), self.source_graph['vertices'][layer])
-
-            min_l1 = vertices_id[0]
-            max_l1 = vertices_id[-1]
-
-            # How many edges per pair of layers?
-            for l2 in range(layer+1, self.source_graph['layers']):
-                vertices_id_l2 = self.source_graph['vertices_by_type'][l2]
-                min_l2 = vertices_id_l2[0]
-                max_l2 = vertices_id_l2[-1]
-                sum_edges = sum([sum(x[min_l2:max_l2+1])
-                                 for x in self.source_graph.get_adjacency()[min_l1:max_l1+1]])
-                print(f"Sum edges layers {layer} and {l2} = ", sum_edges)
-        print("--------------------------------------------------")
+            if self.gmv[layer] is not None:
+                self.gmv[layer] = min(
+                    self.gmv[layer] + self.statistics.isolated[layer], self.source_graph['vertices'][layer])
+
+        if self.hub_mode not in ['skip', 'sample']:
+            print('Hub mode ' + self.hub_mode + ' is invalid.')
+            sys.exit(1)
+
+        if self.adjacency_backend not in ['auto', 'sets', 'bitsets']:
+            print('Adjacency backend ' + self.adjacency_backend + ' is invalid.')
+            sys.exit(1)
+
+        if self.similarity_engine not in ['batch', 'pairwise']:
+            print('Similarity engine ' + self.similarity_engine + ' is invalid.')
+            sys.exit(1)
+
+        # Two-hop expansion: every pair, the approximate most similar ones, or
+        # the pairs left when paths through hubs are skipped or sampled
+        self.expansion = dict(lsh=None, hubs=None, backend=self.adjacency_backend, engine=self.similarity_engine)
+        if self.lsh_top_k:
+            self.expansion['lsh'] = dict(
+                top_k=self.lsh_top_k, threshold=self.lsh_threshold, num_perm=self.lsh_permutations)
+        if self.hub_degree is not None or self.hub_percentile is not None:
+            self.expansion['hubs'] = dict(
+                degree=self.hub_degree, percentile=self.hub_percentile, mode=self.hub_mode, sample=self.hub_sample)
+
+        # Neighborhoods and similarities of mlpb, in at most cache_memory megabytes. A
+        # layer matched by a worker gets its own cache: with threads, the budget is
+        # split evenly among the workers and this process
+        budget = None if self.cache_memory is None else self.cache_memory * 2 ** 20
+        self.task_memory = budget if budget is None or self.threads == 1 else budget // (self.threads + 1)
+        self.cache = MatchingCache(self.task_memory)
+
+        # Spans of the levels, with the matching of each layer and the contraction
+        if self.timing is None:
+            self.timing = Timing()
 
     def run(self):
 
+        # Workers are started once and reused by every level
+        pool = worker_pool(self.threads) if self.threads > 1 else None
+        try:
+            self.coarse(pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.publish(len(self.hierarchy_graphs))
+
+    def load_hierarchy(self, filename):
+        """ Hierarchy of a .mfbn file, whose graphs are only built when accessed """
+
+        hierarchy = Hierarchy(filename)
+        self.hierarchy_graphs = hierarchy
+        self.hierarchy_levels = hierarchy.levels
+        self.published = len(hierarchy)
+
+    def publish(self, count):
+        """
+        Hand the levels up to count to on_level(index, level, graph), e.g., to
+        save them while the next levels are computed. A level is final once
+        the next one is contracted, which sets its successors.
+        """
+
+        if self.on_level is not None:
+            while self.published < count:
+                self.on_level(self.published + 1, self.hierarchy_levels[self.published],
+                              self.hierarchy_graphs[self.published])
+                self.published += 1
+
+    def match(self, graph, tasks, pool):
+        """
+        Run the matching tasks of a level. With a pool, the graph arrays are
+        published in shared memory once per level instead of pickling the graph
+        for every task. Layers split among the workers (see parallel_layer)
+        are matched here, while the other layers run in the pool.
+        """
+
+        if pool is None:
+            return [match_layer(graph, *task) for task in tasks]
+
+        shared = SharedGraph(graph) if shared_memory is not None else None
+        source = shared.source if shared else graph
+        try:
+            processes = [None if self.parallel_layer and task[1] in ['rgmb', 'mlpb'] else
+                         pool.apply_async(match_layer, (source,) + self.pooled(*task)) for task in tasks]
+            results = [self.match_split(graph, source, pool, *task) if process is None else None
+                       for task, process in zip(tasks, processes)]
+            return [result if process is None else process.get() for result, process in zip(results, processes)]
+        finally:
+            if shared:
+                shared.release()
+
+    def pooled(self, layer, matching, similarity, projection, kwargs, expansion):
+        """
+        Task sent to the pool: the cache of this process is replaced by the
+        budget of a cache that the worker creates for the task, as a pickled
+        copy would neither be shared nor send its entries back.
+        """
+
+        if 'cache' in kwargs:
+            kwargs = {key: value for key, value in kwargs.items() if key != 'cache'}
+            kwargs['cache_memory'] = self.task_memory
+        return layer, matching, similarity, projection, kwargs, expansion
+
+    def match_split(self, graph, source, pool, layer, matching, similarity, projection, kwargs, expansion):
+        """
+        Matching of a layer whose scoring is split among the workers, one chunk
+        of vertices each: rgmb candidates are ranked and mlpb neighborhoods are
+        prefetched in parallel, then the greedy selection and the label
+        propagation sweeps run here on the gathered results. As they visit the
+        vertices in the same order, the matching is the same of threads = 1.
+        """
+
+        # Counters of the chunks scored by the workers
+        scattered = dict(candidates=0, evaluations=0, pruned=0)
+
+        def scatter(function, vertices, *args):
+            chunks = [chunk for chunk in numpy.array_split(numpy.asarray(vertices), self.threads) if len(chunk)]
+            processes = [pool.apply_async(function, (source, chunk, similarity, expansion) + args)
+                         for chunk in chunks]
+            results = []
+            for process in processes:
+                result, chunk_counters = process.get()
+                for key, value in chunk_counters.items():
+                    scattered[key] += value
+                results.append(result)
+            return results
+
+        def candidates(vertices):
+            results = scatter(rank_chunk, vertices)
+            offsets = numpy.cumsum([0] + [len(ranked) for _, ranked in results])
+            indptr = [numpy.zeros(1, dtype=numpy.int64)]
+            indptr += [chunk_indptr[1:] + offset for (chunk_indptr, _), offset in zip(results, offsets)]
+            ranked = [numpy.empty(0, dtype=numpy.int64)] + [ranked for _, ranked in results]
+            return numpy.concatenate(indptr), numpy.concatenate(ranked)
+
+        def prefetch(vertices, hop, low, high):
+            results = scatter(hop_chunk, vertices, hop, low, high)
+            neighborhoods = [neighborhood for chunk, _ in results for neighborhood in chunk]
+            scores = [score for _, chunk in results for score in chunk]
+            return neighborhoods, scores
+
+        if matching == 'rgmb':
+            kwargs['candidates'] = candidates
+        else:
+            kwargs['prefetch'] = prefetch
+        vertices, clusters, stats = match_layer(graph, layer, matching, similarity, projection, kwargs, expansion)
+        for key, value in scattered.items():
+            stats[key] += value
+        return vertices, clusters, stats
+
+    def coarse(self, pool):
+
         graph = self.source_graph.copy()
 
         # Starting neighborhood with two hops
         hop = 2
-        print(f"------------------------------ hop = {hop}")
+        logger.info('Coarsening with %d hops', hop)
         while True:
-            level = graph['level']
+            level = graph['level'][:]
             contract = False
-            args = []
+            self.cache.clear()
+            tasks = []
             layers = self.layers_to_coarse if self.layers_to_coarse else range(
                 graph['layers'])
             for layer in layers:
                 do_matching = True
                 if self.gmv[layer] is None and level[layer] >= self.max_levels[layer]:
-                    print(
-                        "Layer = {layer}. Max levels reached with {level[layer]} levels.")
+                    logger.info('Layer %d: max levels reached with %d levels', layer, level[layer])
                     do_matching = False
                 elif self.gmv[layer] and graph['vertices'][layer] <= self.gmv[layer]:
-                    print(
-                        f"Layer = {layer}. Minimum vertices reached with {graph['vertices'][layer]} vertices.")
+                    logger.info('Layer %d: minimum vertices reached with %d vertices', layer, graph['vertices'][layer])
                     do_matching = False
 
                 if do_matching:
@@ -218,7 +446,6 @@ class Coarsening:
 
                     kwargs['gmv'] = self.gmv[layer]
                     if self.matching[layer] in ['mlpb', 'gmb', 'rgmb']:
-                        kwargs['vertices'] = graph['vertices_by_type'][layer]
                         kwargs['reverse'] = self.reverse[layer]
                     if self.matching[layer] in ['mlpb', 'rgmb']:
                         kwargs['seed_priority'] = self.seed_priority[layer]
@@ -228,58 +455,62 @@ class Coarsening:
                         kwargs['tolerance'] = self.tolerance[layer]
                         kwargs['itr'] = self.itr[layer]
                         kwargs['hop'] = hop
+                        kwargs['incremental'] = self.incremental
+                        kwargs['cache'] = self.cache
+                    if self.matching[layer] in ['mnmf']:
+                        kwargs['k'] = self.nmf_components
+                        kwargs['fit'] = self.nmf_fit
+                        kwargs['memory'] = self.nmf_memory
 
-                    if self.matching[layer] in ['hem', 'lem', 'rm', 'mnmf', 'msvm']:
-                        graph['projection'] = getattr(Similarity(
-                            graph, graph['adjlist']), self.projection)
-                        one_mode_graph = graph.weighted_one_mode_projection(
-                            graph['vertices_by_type'][layer], similarity=self.similarity[layer])
-                        matching_function = getattr(
-                            one_mode_graph, self.matching[layer])
-                    else:
-                        graph['similarity'] = getattr(Similarity(
-                            graph, graph['adjlist']), self.similarity[layer])
-                        matching_function = getattr(
-                            graph, self.matching[layer])
-
-                    # Create a args for the engine multiprocessing.pool
-                    args.append([(matching_function, kwargs)])
+                    tasks.append((layer, self.matching[layer], self.similarity[layer], self.projection, kwargs,
+                                  self.expansion))
 
             if contract:
-                # Create pools
-                pool = mp.Pool(processes=self.threads)
-                processes = []
-                for arg in args:
-                    processes.append(pool.starmap_async(
-                        modified_starmap_async, arg))
-
-                # Merge chunked solutions
-                matching = numpy.arange(graph.vcount())
-                for process in processes:
-                    result = process.get()[0]
-                    vertices = numpy.where(result > -1)[0]
-                    matching[vertices] = result[vertices]
-
-                # Close processes
-                pool.close()
-                pool.join()
-
-                # Contract current graph using the matching
-                coarsened_graph = graph.contract(matching)
-                coarsened_graph['level'] = level
+                with self.timing.span('Level %d' % (len(self.hierarchy_graphs) + 1), hop=hop):
+
+                    # Merge chunked solutions; each layer is a span measured by its task
+                    matching = numpy.arange(graph.vcount())
+                    with self.timing.span('Matching'):
+                        for task, (vertices, result, stats) in zip(tasks, self.match(graph, tasks, pool)):
+                            matching[vertices] = result
+                            self.timing.add_span('Layer %d (%s)' % (task[0], task[1]), stats.pop('start'),
+                                                 stats.pop('end'), stats.pop('pid'), **stats)
+
+                    # Contract current graph using the matching
+                    with self.timing.span('Contraction'):
+                        coarsened_graph = graph.contract(matching)
+                    coarsened_graph['level'] = level
+                    self.publish(len(self.hierarchy_graphs))
+
+                    # Release the set-based structures of the finer graph
+                    graph['adjlist'], graph['similarity'], graph['projection'] = None, None, None
+
+                    # Per-level summary counters
+                    summary = dict(
+                        level=len(self.hierarchy_graphs) + 1, hop=hop, layers=[task[0] for task in tasks],
+                        vertices=coarsened_graph['vertices'], edges=coarsened_graph.ecount(),
+                        merged=graph.vcount() - coarsened_graph.vcount())
+                    self.timing.count(vertices=coarsened_graph.vcount(), edges=coarsened_graph.ecount(),
+                                      merged=summary['merged'])
+                    logger.info('Level %(level)d (hop %(hop)d, layers %(layers)s): %(merged)d vertices merged, '
+                                'vertices %(vertices)s, %(edges)d edges', summary)
+                    logger.debug('Level %d: %s', summary['level'], self.cache)
 
                 if coarsened_graph.vcount() == graph.vcount():
-                    print(
-                        f"It didn't improve. Vcount = {coarsened_graph.vcount()}. matching[vertices] = {matching[vertices]}\n")
+                    logger.info('No vertex was merged with %d hops', hop)
                     if hop >= self.max_hops:
                         break
                     hop += 1  # try with one more hop
-                    print(f"\n\n------------------------------ hop = {hop}\n")
+                    logger.info('Coarsening with %d hops', hop)
+
+                self.summary.append(summary)
 
                 self.hierarchy_graphs.append(coarsened_graph)
                 self.hierarchy_levels.append(level[:])
                 graph = coarsened_graph
             else:
-                print("There is no available matching.")
+                logger.info('There is no available matching')
                 break
-            print("\n")
+
+        # Levels of the last attempt, even if it merged no vertex
+        self.achieved_levels = level
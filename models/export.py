@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Export of coarsened graphs
+
+Copyright (C) 2020 Alan Valejo <alanvalejo@gmail.com> All rights reserved
+
+This program comes with ABSOLUTELY NO WARRANTY. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS
+WITH YOU.
+
+Owner or contributors are not liable for any direct, indirect, incidental, special, exemplary, or consequential
+damages, (such as loss of data or profits, and others) arising in any way out of the use of this software,
+even if advised of the possibility of such damage.
+
+This program is free software and distributed in the hope that it will be useful: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with this program. If not,
+see http://www.gnu.org/licenses/.
+
+Giving credit to the author by citing the papers.
+"""
+
+
+import numpy
+
+__maintainer__ = 'Alan Valejo'
+__email__ = 'alanvalejo@gmail.com'
+__author__ = 'Alan Valejo'
+__credits__ = ['Alan Valejo']
+__homepage__ = 'https://www.alanvalejo.com.br'
+__license__ = 'GNU.GPL.v3'
+__docformat__ = 'markdown en'
+__version__ = '0.1'
+__date__ = '2020-05-05'
+
+# Values formatted and written at a time, and size of the file buffers
+chunk_size = 2 ** 20
+buffer_size = 2 ** 22
+
+
+def join_rows(indptr, values, sep=' '):
+    """
+    Text of the offset-encoded rows values[indptr[i]:indptr[i + 1]], one line
+    per row with its values joined by sep, formatted at once
+    """
+
+    counts = numpy.diff(indptr)
+    pieces = values.astype(str).astype(object)
+    ends = numpy.full(len(values), sep, dtype=object)
+    ends[indptr[1:][counts > 0] - 1] = '\n'
+    pieces = numpy.insert(pieces + ends, indptr[:-1][counts == 0], '\n')
+    return ''.join(pieces.tolist())
+
+
+def write_rows(filename, indptr, values, sep=' '):
+    """ Write the rows of join_rows in chunks of about chunk_size values """
+
+    with open(filename, 'w+', buffering=buffer_size) as f:
+        start, rows = 0, len(indptr) - 1
+        while start < rows:
+            end = numpy.searchsorted(indptr, indptr[start] + chunk_size, side='right') - 1
+            end = min(max(start + 1, end), rows)
+            f.write(join_rows(indptr[start:end + 1] - indptr[start], values[indptr[start]:indptr[end]], sep))
+            start = end
+
+
+def write_values(filename, values):
+    """ Write one integer per line, as numpy.savetxt with fmt='%d' """
+
+    values = numpy.asarray(values).astype(numpy.int64)
+    write_rows(filename, numpy.arange(len(values) + 1), values)
+
+
+def write_gml(filename, graph):
+    """ GML of the coarsened graph, with its memberships as vertex attributes """
+
+    gml = graph.to_igraph()
+    gml['layers'] = str(graph['layers'])
+    gml['vertices'] = ','.join(map(str, graph['vertices']))
+    gml['level'] = ','.join(map(str, graph['level']))
+    gml.vs['name'] = numpy.arange(graph.vcount()).astype(str).tolist()
+    gml.vs['type'] = graph.type.astype(str).tolist()
+    gml.vs['weight'] = graph.weight.astype(str).tolist()
+    gml.vs['successor'] = graph.successor.astype(str).tolist()
+    gml.vs['source'] = join_rows(*graph.source_arrays(), sep=',').split('\n')[:-1]
+    gml.vs['predecessor'] = join_rows(graph.predecessor_ptr, graph.predecessor, ',').split('\n')[:-1]
+    gml.write(filename, format='gml')
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Out-of-core arrays of graphs larger than memory
+
+Copyright (C) 2020 Alan Valejo <alanvalejo@gmail.com> All rights reserved
+
+This program comes with ABSOLUTELY NO WARRANTY. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS
+WITH YOU.
+
+Owner or contributors are not liable for any direct, indirect, incidental, special, exemplary, or consequential
+damages, (such as loss of data or profits, and others) arising in any way out of the use of this software,
+even if advised of the possibility of such damage.
+
+This program is free software and distributed in the hope that it will be useful: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with this program. If not,
+see http://www.gnu.org/licenses/.
+
+Giving credit to the author by citing the papers.
+"""
+
+
+import atexit
+import os
+import shutil
+import tempfile
+
+import numpy
+
+__maintainer__ = 'Alan Valejo'
+__email__ = 'alanvalejo@gmail.com'
+__author__ = 'Alan Valejo'
+__credits__ = ['Alan Valejo']
+__homepage__ = 'https://www.alanvalejo.com.br'
+__license__ = 'GNU.GPL.v3'
+__docformat__ = 'markdown en'
+__version__ = '0.1'
+__date__ = '2020-05-05'
+
+# Entries grouped or sorted in memory at a time
+chunk_size = 2 ** 24
+
+
+class Spill(object):
+    """
+    Directory of the out-of-core mode. Edge-sized arrays (edge list, CSR
+    indices and data, two-hop pairs) are written to raw files and memory-mapped
+    read-only, while vertex-sized arrays stay in memory. Graphs with at most
+    in_memory_edges edges are kept in memory. Files are named uniquely, so
+    workers can spill at the same time, and removed at exit.
+    """
+
+    def __init__(self, directory, in_memory_edges=2 ** 26, chunk_size=chunk_size):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='mfbn-', dir=directory)
+        self.in_memory_edges = in_memory_edges
+        self.chunk_size = chunk_size
+        atexit.register(self.close)
+
+    def spills(self, edges):
+        return edges > self.in_memory_edges
+
+    def writer(self, dtype=None, width=None):
+        handle, filename = tempfile.mkstemp(suffix='.bin', dir=self.directory)
+        os.close(handle)
+        return ArrayWriter(filename, dtype, width)
+
+    def array(self, array, dtype=None):
+        """ Memory-mapped copy of array, written in chunks """
+
+        writer = self.writer(dtype or array.dtype, array.shape[1] if array.ndim > 1 else None)
+        for start in range(0, len(array), self.chunk_size):
+            writer.append(array[start:start + self.chunk_size])
+        return writer.close()
+
+    def release(self, *arrays):
+        """ Remove the files of the given memory-mapped arrays """
+
+        for array in arrays:
+            if isinstance(array, numpy.memmap) and os.path.dirname(array.filename) == self.directory:
+                os.remove(array.filename)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ArrayWriter(object):
+    """ Array appended by chunks to a raw file and memory-mapped on close """
+
+    def __init__(self, filename, dtype=None, width=None):
+        self.filename = filename
+        self.dtype = None if dtype is None else numpy.dtype(dtype)
+        self.width = width
+        self.count = 0
+        self.file = open(filename, 'wb')
+
+    def append(self, array):
+        if self.dtype is None:
+            self.dtype = numpy.asarray(array).dtype
+        array = numpy.ascontiguousarray(array, dtype=self.dtype)
+        self.file.write(array.tobytes())
+        self.count += len(array)
+
+    def close(self):
+        self.file.close()
+        dtype = self.dtype or numpy.dtype(numpy.float64)
+        shape = (self.count,) if self.width is None else (self.count, self.width)
+        if self.count == 0:
+            os.remove(self.filename)
+            return numpy.empty(shape, dtype=dtype)
+        return numpy.memmap(self.filename, dtype=dtype, mode='r', shape=shape)
+
+    def load(self):
+        """ In-memory array of the writer, whose file is removed """
+
+        array = numpy.array(self.close())
+        if self.count:
+            os.remove(self.filename)
+        return array
+
+
+def promote(spill, array):
+    """ In-memory copy of a memory-mapped array, whose file is removed """
+
+    if not isinstance(array, numpy.memmap):
+        return array
+    copy = numpy.array(array)
+    spill.release(array)
+    return copy
+
+
+def group(spill, keys, weights=None):
+    """
+    Disk-backed group-by of integer keys: the distinct keys in increasing
+    order, the positions of their first and last occurrence and, with
+    weights, the sum of their weights in order of occurrence, i.e., what
+    numpy.unique and numpy.bincount give in memory. Keys are distributed by
+    ranges, taken from a sample, into bucket files of about chunk_size
+    entries, and each bucket is grouped in memory.
+    """
+
+    size = spill.chunk_size
+    buckets = -(-len(keys) // size)
+    if buckets > 1:
+        sample = numpy.sort(keys[::max(1, len(keys) // (64 * buckets))])
+        splitters = numpy.unique(sample[numpy.linspace(0, len(sample), buckets, endpoint=False).astype(int)[1:]])
+    else:
+        splitters = numpy.empty(0, dtype=keys.dtype)
+
+    # Distribution pass: entries keep their order of occurrence in a bucket
+    parts = [(spill.writer(numpy.int64), spill.writer(numpy.int64),
+              None if weights is None else spill.writer(numpy.float64)) for _ in range(len(splitters) + 1)]
+    for start in range(0, len(keys), size):
+        chunk = numpy.asarray(keys[start:start + size], dtype=numpy.int64)
+        bucket = numpy.searchsorted(splitters, chunk, side='right')
+        order = numpy.argsort(bucket, kind='stable')
+        bounds = numpy.searchsorted(bucket[order], numpy.arange(len(parts) + 1))
+        for index, (key_part, position_part, weight_part) in enumerate(parts):
+            selected = order[bounds[index]:bounds[index + 1]]
+            key_part.append(chunk[selected])
+            position_part.append(start + selected)
+            if weight_part is not None:
+                weight_part.append(weights[start:start + size][selected])
+
+    # Group pass: buckets cover increasing key ranges
+    result = [spill.writer(numpy.int64), spill.writer(numpy.int64), spill.writer(numpy.int64)]
+    sums = None if weights is None else spill.writer(numpy.float64)
+    for key_part, position_part, weight_part in parts:
+        bucket_keys, positions = key_part.load(), position_part.load()
+        distinct, first, inverse = numpy.unique(bucket_keys, return_index=True, return_inverse=True)
+        _, last = numpy.unique(bucket_keys[::-1], return_index=True)
+        result[0].append(distinct)
+        result[1].append(positions[first])
+        result[2].append(positions[len(positions) - 1 - last])
+        if weight_part is not None:
+            sums.append(numpy.bincount(inverse.ravel(), weights=weight_part.load(), minlength=len(distinct)))
+    return tuple(writer.close() for writer in result) + (None if sums is None else sums.close(),)
+
+
+def occurrence_order(spill, first):
+    """ Groups of group sorted by their first occurrence """
+
+    _, order, last, _ = group(spill, first)
+    spill.release(last)
+    return order
+
+
+def spill_ncol(spill, chunks):
+    """
+    Edge list and weights of the chunks of read_ncol written to disk, without
+    repeated (u, v) pairs as unique_edges of mgraph
+    """
+
+    edge_part, weight_part = spill.writer(numpy.int64, 2), spill.writer(numpy.float64)
+    weighted, high = False, -1
+    for edges, weights in chunks:
+        edge_part.append(edges)
+        weight_part.append(numpy.ones(len(edges)) if weights is None else weights)
+        weighted |= weights is not None
+        high = max(high, int(edges.max()))
+    edges, weights = edge_part.close(), weight_part.close()
+    dtype = numpy.int32 if high < numpy.iinfo(numpy.int32).max else numpy.int64
+
+    keys = spill.writer(numpy.int64)
+    for start in range(0, len(edges), spill.chunk_size):
+        chunk = edges[start:start + spill.chunk_size]
+        keys.append(chunk[:, 0] * (high + 1) + chunk[:, 1])
+    keys = keys.close()
+    distinct, first, last, _ = group(spill, keys)
+    order = occurrence_order(spill, first)
+
+    unique, unique_weights = spill.writer(dtype, 2), spill.writer(numpy.float64 if weighted else numpy.int64)
+    for start in range(0, len(order), spill.chunk_size):
+        selected = order[start:start + spill.chunk_size]
+        unique.append(edges[first[selected]])
+        unique_weights.append(weights[last[selected]])
+    spill.release(edges, weights, keys, distinct, first, last, order)
+    return unique.close(), unique_weights.close()
+
+
+def contract_edges(spill, edges, edge_weight, successor, uniqid):
+    """
+    Coarse edges of contract in mgraph with a disk-backed group-by: the
+    successor pairs are merged in order of first occurrence and their weights
+    summed in their original order
+    """
+
+    keys = spill.writer(numpy.int64)
+    for start in range(0, len(edges), spill.chunk_size):
+        successors = successor[edges[start:start + spill.chunk_size]]
+        keys.append(successors.min(axis=1) * uniqid + successors.max(axis=1))
+    keys = keys.close()
+    distinct, first, last, sums = group(spill, keys, edge_weight)
+    order = occurrence_order(spill, first)
+
+    dtype = numpy.int32 if uniqid < numpy.iinfo(numpy.int32).max else numpy.int64
+    weight_dtype = edge_weight.dtype if edge_weight.dtype.kind in 'iu' else numpy.float64
+    coarse, coarse_weights = spill.writer(dtype, 2), spill.writer(weight_dtype)
+    for start in range(0, len(order), spill.chunk_size):
+        selected = distinct[order[start:start + spill.chunk_size]]
+        coarse.append(numpy.column_stack((selected // uniqid, selected % uniqid)))
+        coarse_weights.append(sums[order[start:start + spill.chunk_size]])
+    spill.release(keys, distinct, first, last, sums, order)
+    return coarse.close(), coarse_weights.close()
+
+
+def set_edges(graph, edges, weights, spill):
+    """
+    set_edges of mgraph on disk: the edge list, CSR indices and data are
+    memory-mapped. The CSR entries of both directions are distributed by
+    ranges of rows into bucket files of about chunk_size entries, and each
+    bucket is sorted and its parallel edges merged in memory.
+    """
+
+    n = graph.vcount()
+    size = spill.chunk_size
+    dtype = numpy.int32 if n < numpy.iinfo(numpy.int32).max else numpy.int64
+    if not isinstance(edges, numpy.memmap) or edges.dtype != dtype:
+        edges = spill.array(numpy.asarray(edges).reshape(-1, 2), dtype)
+    if not isinstance(weights, numpy.memmap):
+        weights = spill.array(numpy.asarray(weights))
+
+    # Degrees, strengths and CSR row lengths, accumulated in edge order
+    degrees = numpy.zeros(n, dtype=numpy.int64)
+    strengths = numpy.zeros(n)
+    entries = numpy.zeros(n, dtype=numpy.int64)
+    for start in range(0, len(edges), size):
+        chunk, chunk_weights = edges[start:start + size], weights[start:start + size]
+        degrees += numpy.bincount(chunk.ravel(), minlength=n)
+        numpy.add.at(strengths, chunk.ravel(), numpy.repeat(chunk_weights, 2))
+        loop = chunk[:, 0] == chunk[:, 1]
+        entries += numpy.bincount(chunk[:, 0], minlength=n) + numpy.bincount(chunk[~loop, 1], minlength=n)
+
+    # Distribution pass by ranges of rows
+    row_bucket = (numpy.cumsum(entries) - entries) // size
+    parts = [(spill.writer(numpy.int64), spill.writer(weights.dtype)) for _ in range(int(row_bucket.max()) + 1)]
+    for start in range(0, len(edges), size):
+        chunk, chunk_weights = edges[start:start + size], weights[start:start + size]
+        u, v = chunk[:, 0].astype(numpy.int64), chunk[:, 1].astype(numpy.int64)
+        loop = u == v
+        rows = numpy.concatenate((u, v[~loop]))
+        keys = rows * n + numpy.concatenate((v, u[~loop]))
+        data = numpy.concatenate((chunk_weights, chunk_weights[~loop]))
+        bucket = row_bucket[rows]
+        order = numpy.argsort(bucket, kind='stable')
+        bounds = numpy.searchsorted(bucket[order], numpy.arange(len(parts) + 1))
+        for index, (key_part, data_part) in enumerate(parts):
+            selected = order[bounds[index]:bounds[index + 1]]
+            key_part.append(keys[selected])
+            data_part.append(data[selected])
+
+    # Sort pass: buckets cover increasing rows
+    lengths = numpy.zeros(n, dtype=numpy.int64)
+    indices, values = spill.writer(dtype), spill.writer(weights.dtype)
+    for key_part, data_part in parts:
+        keys = key_part.load()
+        distinct, inverse = numpy.unique(keys, return_inverse=True)
+        sums = numpy.bincount(inverse.ravel(), weights=data_part.load(), minlength=len(distinct))
+        lengths += numpy.bincount(distinct // n, minlength=n)
+        indices.append(distinct % n)
+        values.append(sums)
+
+    graph.edges, graph.edge_weight = edges, weights
+    graph.indptr = numpy.concatenate(([0], numpy.cumsum(lengths))).astype(numpy.int64)
+    graph.indices, graph.data = indices.close(), values.close()
+    graph.degrees, graph.strengths = degrees, strengths
+    graph['adjlist'] = None
+
+
+def best_pairs(rows, cols, scores, size, reverse=True, chunk_size=chunk_size):
+    """
+    best_pairs of mgraph over memory-mapped pairs, with keys -scores when
+    reverse: the `size` lowest keys left are kept by a pass over the chunks,
+    and the window they bound is gathered by a second pass, so only a window
+    is in memory at a time
+    """
+
+    def keys(start):
+        chunk = numpy.asarray(scores[start:start + chunk_size])
+        return -chunk if reverse else chunk
+
+    def left(chunk, low):
+        return numpy.ones(len(chunk), dtype=bool) if low is None else ~(chunk <= low)
+
+    remaining, low = len(scores), None
+    size = max(2 * size, 1)
+    while remaining:
+        kth = None
+        if size < remaining:
+            lowest = numpy.empty(0)
+            for start in range(0, len(scores), chunk_size):
+                chunk = keys(start)
+                lowest = numpy.concatenate((lowest, chunk[left(chunk, low)]))
+                if len(lowest) > size + 1:
+                    lowest = numpy.partition(lowest, size)[:size + 1]
+            kth = numpy.partition(lowest, size)[size]
+            if numpy.isnan(kth):
+                kth = None
+
+        positions, selected_keys = [], []
+        for start in range(0, len(scores), chunk_size):
+            chunk = keys(start)
+            taken = left(chunk, low)
+            if kth is not None:
+                taken &= chunk <= kth
+            positions.append(start + numpy.flatnonzero(taken))
+            selected_keys.append(chunk[taken])
+        selected = numpy.concatenate(positions)
+        selected = selected[numpy.argsort(numpy.concatenate(selected_keys), kind='stable')]
+        remaining = 0 if kth is None else remaining - len(selected)
+        low = kth
+        yield zip(numpy.asarray(rows[selected]).tolist(), numpy.asarray(cols[selected]).tolist())
+        size *= 4
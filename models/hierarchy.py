@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Binary hierarchy format (.mfbn)
+
+Copyright (C) 2020 Alan Valejo <alanvalejo@gmail.com> All rights reserved
+
+This program comes with ABSOLUTELY NO WARRANTY. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS
+WITH YOU.
+
+Owner or contributors are not liable for any direct, indirect, incidental, special, exemplary, or consequential
+damages, (such as loss of data or profits, and others) arising in any way out of the use of this software,
+even if advised of the possibility of such damage.
+
+This program is free software and distributed in the hope that it will be useful: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with this program. If not,
+see http://www.gnu.org/licenses/.
+
+Giving credit to the author by citing the papers.
+"""
+
+
+import json
+import struct
+import threading
+import numpy
+
+from models import external
+from models.mgraph import MGraph, gather
+
+__maintainer__ = 'Alan Valejo'
+__email__ = 'alanvalejo@gmail.com'
+__author__ = 'Alan Valejo'
+__credits__ = ['Alan Valejo']
+__homepage__ = 'https://www.alanvalejo.com.br'
+__license__ = 'GNU.GPL.v3'
+__docformat__ = 'markdown en'
+__version__ = '0.1'
+__date__ = '2020-05-05'
+
+# A .mfbn file is a sequence of raw arrays, each one aligned to `alignment`
+# bytes, followed by a JSON index (offset, dtype and shape of the arrays of
+# every level, and their attributes) and a trailer with the index size
+magic = b'MFBN'
+version = 1
+alignment = 64
+trailer = struct.Struct('<4sIQ')
+
+# Arrays stored for each level; sources are resolved from the predecessors
+level_arrays = [
+    'indptr', 'indices', 'data', 'edges', 'edge_weight', 'degrees', 'strengths', 'type', 'weight', 'name',
+    'successor', 'predecessor_ptr', 'predecessor'
+]
+level_attributes = ['vertices', 'layers', 'level']
+
+
+class HierarchyWriter(object):
+    """
+    Writes levels, possibly from several threads and in any order, to a
+    .mfbn file. Levels must be 1 to k, as the sources of a level are resolved
+    through the predecessors of the levels below it. The index is only
+    written by close, so a file without it (e.g., of an interrupted run) is
+    rejected by the reader.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def add(self, index, level, graph):
+        """ Write level `index` (1 for the first coarsened graph) """
+
+        entry = {'level': list(level), 'attributes': {key: graph[key] for key in level_attributes}, 'arrays': {}}
+        with self.lock:
+            for key in level_arrays:
+                array = getattr(graph, key)
+                self.file.write(b'\0' * (-self.file.tell() % alignment))
+                entry['arrays'][key] = (self.file.tell(), array.dtype.str, array.shape)
+                for start in range(0, len(array), external.chunk_size):
+                    self.file.write(numpy.ascontiguousarray(array[start:start + external.chunk_size]).tobytes())
+            self.index[index] = entry
+
+    def close(self):
+        with self.lock:
+            index = json.dumps([self.index[key] for key in sorted(self.index)]).encode('utf-8')
+            self.file.write(index)
+            self.file.write(trailer.pack(magic, version, len(index)))
+            self.file.close()
+
+
+def save(filename, graphs, levels):
+    """ Write the hierarchy graphs and their levels to a .mfbn file """
+
+    writer = HierarchyWriter(filename)
+    for index, (level, graph) in enumerate(zip(levels, graphs)):
+        writer.add(index + 1, level, graph)
+    writer.close()
+
+
+class Hierarchy(object):
+    """
+    Lazy sequence of the graphs of a .mfbn file. The file is memory-mapped:
+    a level is only built when indexed, as copy-on-write views on the
+    mapping (the file itself is never modified), and pages are read from disk when the arrays are accessed, so one level
+    or the source set of one vertex costs no more than its own bytes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.buffer = numpy.memmap(filename, dtype=numpy.uint8, mode='c')
+        if len(self.buffer) < trailer.size:
+            raise ValueError(filename + ' is not a .mfbn file')
+        file_magic, file_version, size = trailer.unpack(self.buffer[-trailer.size:].tobytes())
+        if file_magic != magic or file_version != version:
+            raise ValueError(filename + ' is not a .mfbn file of version ' + str(version))
+        end = len(self.buffer) - trailer.size
+        self.index = json.loads(self.buffer[end - size:end].tobytes().decode('utf-8'))
+        self.levels = [entry['level'] for entry in self.index]
+        self.graphs = {}
+        self.steps = []
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def array(self, index, key):
+        """ Array `key` of level index (0-based), as a view on the mapping """
+
+        offset, dtype, shape = self.index[index]['arrays'][key]
+        dtype = numpy.dtype(dtype)
+        count = int(numpy.prod(shape, dtype=numpy.int64))
+        return numpy.frombuffer(self.buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index not in self.graphs:
+            graph = MGraph.__new__(MGraph)
+            graph.attributes = dict(self.index[index]['attributes'])
+            for key in level_arrays:
+                setattr(graph, key, self.array(index, key))
+            graph.source_chain = self.chain(index)
+            graph.source_ptr, graph.source = None, None
+            graph['adjlist'] = None
+            graph['similarity'] = None
+            graph.set_vertices_by_type()
+            self.graphs[index] = graph
+        return self.graphs[index]
+
+    def chain(self, index):
+        """
+        Source chain of level index: the successors of the source graph and of
+        the levels below it, each the inverse of the predecessors of the next
+        """
+
+        while len(self.steps) <= index:
+            predecessor_ptr = self.array(len(self.steps), 'predecessor_ptr')
+            predecessor = self.array(len(self.steps), 'predecessor')
+            step = numpy.empty(len(predecessor), dtype=numpy.int64)
+            step[predecessor] = numpy.repeat(numpy.arange(len(predecessor_ptr) - 1), numpy.diff(predecessor_ptr))
+            self.steps.append(step)
+        return self.steps[:index + 1]
+
+    def source(self, index, vertex):
+        """
+        Source vertices of a vertex of level index, without building the
+        level: its predecessors are expanded down to the source graph
+        """
+
+        vertices = numpy.array([vertex], dtype=numpy.int64)
+        for level in range(index, -1, -1):
+            vertices = gather(self.array(level, 'predecessor_ptr'), self.array(level, 'predecessor'), vertices)
+        return vertices
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MinHash and locality-sensitive hashing of neighborhoods
+
+Copyright (C) 2020 Alan Valejo <alanvalejo@gmail.com> All rights reserved
+
+This program comes with ABSOLUTELY NO WARRANTY. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS
+WITH YOU.
+
+Owner or contributors are not liable for any direct, indirect, incidental, special, exemplary, or consequential
+damages, (such as loss of data or profits, and others) arising in any way out of the use of this software,
+even if advised of the possibility of such damage.
+
+This program is free software and distributed in the hope that it will be useful: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with this program. If not,
+see http://www.gnu.org/licenses/.
+
+Giving credit to the author by citing the papers.
+"""
+
+import numpy
+
+__maintainer__ = 'Alan Valejo'
+__email__ = 'alanvalejo@gmail.com'
+__author__ = 'Alan Valejo'
+__credits__ = ['Alan Valejo']
+__homepage__ = 'https://www.alanvalejo.com.br'
+__license__ = 'GNU.GPL.v3'
+__docformat__ = 'markdown en'
+__version__ = '0.1'
+__date__ = '2020-05-05'
+
+# Mersenne prime of the universal hash functions (a * x + b) mod prime
+prime = 2 ** 31 - 1
+
+
+def band_shape(num_perm, threshold):
+    """
+    Number of bands b and of rows per band r (b * r <= num_perm) such that
+    the probability 1 - (1 - s ** r) ** b of two vertices sharing a bucket
+    rises at the Jaccard similarity s = threshold, i.e., (1 / b) ** (1 / r)
+    is the closest to it. A lower threshold gives a higher recall and a
+    lower precision.
+    """
+
+    shapes = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+    return min(shapes, key=lambda shape: abs((1.0 / shape[0]) ** (1.0 / shape[1]) - threshold))
+
+
+def signatures(graph, vertices, num_perm=64, seed=0):
+    """
+    MinHash signatures (num_perm x len(vertices)) of the neighborhoods of the
+    vertices; a vertex without neighbors gets the constant signature prime.
+    """
+
+    random = numpy.random.RandomState(seed)
+    a = random.randint(1, prime, num_perm).astype(numpy.int64)
+    b = random.randint(0, prime, num_perm).astype(numpy.int64)
+    lengths = numpy.diff(graph.indptr)[vertices]
+    neighbors = graph.gather_neighbors(vertices).astype(numpy.int64)
+    starts = (numpy.cumsum(lengths) - lengths)[lengths > 0]
+
+    result = numpy.full((num_perm, len(vertices)), prime, dtype=numpy.int64)
+    if len(starts):
+        for index in range(num_perm):
+            result[index, lengths > 0] = numpy.minimum.reduceat((a[index] * neighbors + b[index]) % prime, starts)
+    return result
+
+
+def candidates(graph, vertices, top_k=10, threshold=0.5, num_perm=64, seed=0):
+    """
+    Approximate most similar pairs of the given vertices, e.g., of a layer.
+    Vertices are bucketed by bands of their MinHash signatures and, within a
+    bucket, each one is paired with the top_k next ones (in random order), so
+    a hub bucket yields a linear number of pairs. Each vertex then keeps its
+    top_k pairs by estimated Jaccard. Returns both directions of the kept
+    pairs, (rows, cols, estimated Jaccard), grouped by row in the given order.
+    """
+
+    vertices = numpy.asarray(vertices, dtype=numpy.int64)
+    minhash = signatures(graph, vertices, num_perm, seed)
+    bands, rows = band_shape(num_perm, threshold)
+    active = numpy.flatnonzero(numpy.diff(graph.indptr)[vertices] > 0)
+    tiebreak = numpy.random.RandomState(seed).permutation(len(vertices))
+
+    # Bucket mates of each band
+    pairs = [numpy.empty((0, 2), dtype=numpy.int64)]
+    for band in range(bands):
+        key = numpy.zeros(len(active), dtype=numpy.uint64)
+        for row in minhash[band * rows:(band + 1) * rows, active]:
+            key = key * numpy.uint64(1000003) ^ row.astype(numpy.uint64)
+        order = numpy.lexsort((tiebreak[active], key))
+        key, members = key[order], active[order]
+        for offset in range(1, top_k + 1):
+            same = key[offset:] == key[:-offset]
+            pairs.append(numpy.column_stack((members[:-offset][same], members[offset:][same])))
+    pairs = numpy.concatenate(pairs)
+    pairs = numpy.unique(numpy.sort(pairs, axis=1), axis=0)
+
+    # Estimated Jaccard: fraction of equal signature entries
+    estimate = numpy.empty(len(pairs))
+    chunk = max(1, 2 ** 24 // num_perm)
+    for start in range(0, len(pairs), chunk):
+        u, v = pairs[start:start + chunk, 0], pairs[start:start + chunk, 1]
+        estimate[start:start + chunk] = (minhash[:, u] == minhash[:, v]).mean(axis=0)
+
+    # Top-k of each vertex; a pair kept by any of its ends is kept for both
+    source = numpy.concatenate((pairs[:, 0], pairs[:, 1]))
+    order = numpy.lexsort((-numpy.concatenate((estimate, estimate)), source))
+    starts = numpy.searchsorted(source[order], source[order])
+    keep = numpy.zeros(len(source), dtype=bool)
+    keep[order[numpy.arange(len(order)) - starts < top_k]] = True
+    keep = keep[:len(pairs)] | keep[len(pairs):]
+    pairs, estimate = pairs[keep], estimate[keep]
+
+    source = numpy.concatenate((pairs[:, 0], pairs[:, 1]))
+    target = numpy.concatenate((pairs[:, 1], pairs[:, 0]))
+    estimate = numpy.concatenate((estimate, estimate))
+    order = numpy.lexsort((-estimate, source))
+    return vertices[source[order]], vertices[target[order]], estimate[order]
@@ -23,25 +23,27 @@ Giving credit to the author by citing the papers.
 """
 
 import operator
+import itertools
+import os
 
 import numpy
 import random
 import math
 import collections
 
-from random import sample
 from igraph import Graph
 from scipy import sparse
-from numpy import dot
-from numpy.linalg import norm
-from numpy import linalg as LA
+from scipy.sparse import csgraph
 from models.similarity import Similarity
-from sklearn.metrics.pairwise import cosine_similarity
-from scipy import spatial
-from sklearn.decomposition import non_negative_factorization
+from models.cache import MatchingCache, missing
+from models import external
 # from sklearn.decomposition import ProjectedGradientNMF
 from sklearn.decomposition import NMF
-import warnings
+try:
+    from sklearn.decomposition import MiniBatchNMF
+except ImportError:  # scikit-learn < 1.1
+    MiniBatchNMF = None
+import logging
 
 __maintainer__ = 'Alan Valejo'
 __email__ = 'alanvalejo@gmail.com'
@@ -53,140 +55,667 @@ __docformat__ = 'markdown en'
 __version__ = '0.1'
 __date__ = '2020-05-05'
 
+logger = logging.getLogger(__name__)
 
-def load_ncol(filename):
+
+def read_ncol(filename, chunksize=1000000):
     """
-    Load ncol npartite graph and generate special attributes
+    Stream an ncol file in chunks of typed arrays, i.e., vertex ids as integers
+    and edge weights as floats (or None when the file is unweighted)
     """
 
-    data = numpy.loadtxt(filename, skiprows=0, dtype=str)
-    dict_edges = dict()
-    for row in data:
-        if len(row) == 3:
-            dict_edges[(int(row[0]), int(row[1]))] = float(row[2])
-        else:
-            dict_edges[(int(row[0]), int(row[1]))] = 1
+    with open(filename) as f:
+        while True:
+            lines = list(itertools.islice(f, chunksize))
+            if not lines:
+                break
+            data = numpy.loadtxt(lines, ndmin=2)
+            if data.size == 0:
+                continue
+            weights = data[:, 2] if data.shape[1] >= 3 else None
+            yield data[:, :2].astype(numpy.int64), weights
+
+
+def unique_edges(edges, weights):
+    """
+    Remove repeated (u, v) pairs keeping the first position and the last weight
+    of each pair, the same result of filling a dict row by row
+    """
+
+    if len(edges) == 0:
+        return edges, weights
+    n = int(edges.max()) + 1
+    keys = edges[:, 0].astype(numpy.int64) * n + edges[:, 1]
+    _, first = numpy.unique(keys, return_index=True)
+    _, last = numpy.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    order = numpy.argsort(first)
+    return edges[first[order]], weights[last[order]]
+
+
+def load_ncol(filename, chunksize=1000000, cache=False):
+    """
+    Load ncol npartite graph and generate special attributes. If cache is
+    enabled, the parsed edge list is stored in a binary sidecar (filename.npz)
+    and reused while the source file does not change.
+    """
+
+    stat = os.stat(filename)
+    cache_filename = filename + '.npz'
+    if cache and os.path.isfile(cache_filename):
+        with numpy.load(cache_filename) as data:
+            if data['size'] == stat.st_size and data['mtime'] == stat.st_mtime_ns:
+                return data['edges'], data['weights']
+
+    chunks = list(read_ncol(filename, chunksize=chunksize))
+    if chunks:
+        edges = numpy.concatenate([chunk for chunk, _ in chunks])
+        weighted = any(weights is not None for _, weights in chunks)
+        weights = numpy.concatenate([
+            numpy.ones(len(chunk)) if weights is None else weights for chunk, weights in chunks])
+        if not weighted:
+            weights = weights.astype(numpy.int64)
+    else:
+        edges, weights = numpy.empty((0, 2), dtype=numpy.int64), numpy.empty(0)
+    del chunks
+
+    dtype = numpy.int32 if len(edges) == 0 or edges.max() < numpy.iinfo(numpy.int32).max else numpy.int64
+    edges, weights = unique_edges(edges.astype(dtype), weights)
+
+    if cache:
+        tmp_filename = cache_filename + '.tmp.npz'
+        try:
+            numpy.savez(tmp_filename, edges=edges, weights=weights, size=stat.st_size, mtime=stat.st_mtime_ns)
+            os.replace(tmp_filename, cache_filename)
+        except OSError:
+            logger.warning('Edge cache %s could not be written', cache_filename)
 
-    edges, weights = list(zip(*dict_edges.items()))
     return edges, weights
 
 
-class MGraph(Graph):
+def gather(indptr, values, rows):
+    """
+    Concatenation of the offset-encoded groups values[indptr[i]:indptr[i + 1]]
+    for each i in rows, in the given order
+    """
+
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    offsets = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+    return values[offsets + numpy.arange(counts.sum())]
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
 
-    def load(self, network_filename, vertices, filename_type='ncol', type_filename=None):
+def best_pairs(rows, cols, key, size):
+    """
+    Pairs in increasing key order (ties in the given order), as a stable
+    sort would give, but lazily: each window is only the `size` lowest
+    keys left (and their ties), selected by a partition, and the window
+    grows fourfold whenever it did not yield enough matches. Pairs beyond
+    the last window are never sorted nor converted to Python objects.
+    """
+
+    remaining = numpy.arange(len(key))
+    size = max(2 * size, 1)
+    while len(remaining):
+        selected = remaining
+        if size < len(remaining):
+            kth = numpy.partition(key[remaining], size)[size]
+            if not numpy.isnan(kth):
+                taken = key[remaining] <= kth
+                selected, remaining = remaining[taken], remaining[~taken]
+        if selected is remaining:
+            remaining = remaining[:0]
+        selected = selected[numpy.argsort(key[selected], kind='stable')]
+        yield zip(rows[selected].tolist(), cols[selected].tolist())
+        size *= 4
+
+
+def greedy_matching(edges, n, min_accepted=0.01):
+    """
+    Positions of the edges taken by the greedy matching that visits the edges
+    in the given order, in that order. An edge is taken when it comes first
+    among the remaining edges of both its endpoints; as the edges taken this
+    way are exactly the greedy ones, the rounds run vectorized and only the
+    tail, once a round takes less than min_accepted of the remaining edges,
+    is visited one edge at a time.
+    """
+
+    a, b = edges[:, 0], edges[:, 1]
+    alive = numpy.arange(len(edges))
+    matched = numpy.zeros(n, dtype=bool)
+    selected = []
+    while len(alive):
+        first = numpy.full(n, len(edges), dtype=numpy.int64)
+        first[b[alive][::-1]] = alive[::-1]
+        first_a = numpy.full(n, len(edges), dtype=numpy.int64)
+        first_a[a[alive][::-1]] = alive[::-1]
+        first = numpy.minimum(first, first_a)
+        taken = alive[(first[a[alive]] == alive) & (first[b[alive]] == alive)]
+        selected.append(taken)
+        matched[a[taken]] = True
+        matched[b[taken]] = True
+        remaining = len(alive) - len(taken)
+        alive = alive[~matched[a[alive]] & ~matched[b[alive]]]
+        if len(taken) < min_accepted * remaining:
+            break
+
+    # Sequential tail
+    visited = matched.tolist()
+    tail = []
+    for index, u, v in zip(alive.tolist(), a[alive].tolist(), b[alive].tolist()):
+        if not visited[u] and not visited[v]:
+            visited[u] = visited[v] = True
+            tail.append(index)
+    selected.append(numpy.array(tail, dtype=numpy.int64))
+    return numpy.sort(numpy.concatenate(selected))
+
+
+def nmf_factors(X, k, budget=None):
+    """
+    Row factors W of X ~ W H. When the factors and the multiplicative update
+    temporaries (about three copies of W and H) exceed the budget in bytes,
+    the factors are fitted by mini-batches of rows that fit in it.
+    """
+
+    if budget is None or MiniBatchNMF is None or 24 * k * sum(X.shape) <= budget:
+        model = NMF(n_components=k, init='random', random_state=0,
+                    max_iter=200, tol=0.005, solver='mu')
+        return model.fit_transform(X)
+
+    batch_size = max(1, int(budget // (24 * (k + X.shape[1]))))
+    model = MiniBatchNMF(n_components=k, init='random', random_state=0,
+                         max_iter=200, tol=0.005, batch_size=batch_size)
+    return model.fit_transform(X)
+
+
+def edge_cosine(W, edges, budget=None):
+    """
+    Cosine of the rows of W at the ends of each edge, 0.0 when a row is null,
+    as scipy.spatial.distance.cosine, computed by chunks of edges whose rows
+    fit in the budget in bytes
+    """
+
+    squared = numpy.einsum('ij,ij->i', W, W)
+    nonzero = W.any(axis=1)
+    chunk = len(edges) if budget is None else max(1, int(budget // (16 * W.shape[1])))
+    weights = numpy.zeros(len(edges))
+    for start in range(0, len(edges), max(chunk, 1)):
+        u, v = edges[start:start + chunk, 0], edges[start:start + chunk, 1]
+        uv = numpy.einsum('ij,ij->i', W[u], W[v])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            distance = numpy.clip(1.0 - uv / numpy.sqrt(squared[u] * squared[v]), 0.0, 2.0)
+        weights[start:start + chunk] = numpy.where(nonzero[u] & nonzero[v], 1 - distance, 0.0)
+    return weights
+
+
+class GraphStatistics(object):
+    """
+    Startup statistics of an n-partite graph, computed in a single O(E) pass:
+    number of edges, vertices with no edges per layer and number of edges
+    between each pair of layers.
+    """
+
+    def __init__(self, graph):
+        layers = graph['layers']
+        self.vertices = list(graph['vertices'])
+        self.edges = graph.ecount()
+        self.isolated_vertices = [
+            numpy.flatnonzero((graph.degrees == 0) & (graph.type == layer)) for layer in range(layers)]
+        self.isolated = [len(isolated) for isolated in self.isolated_vertices]
+        pairs = numpy.zeros(layers * layers, dtype=numpy.int64)
+        for start in range(0, graph.ecount(), external.chunk_size):
+            types = graph.type[graph.edges[start:start + external.chunk_size]]
+            u, v = types[:, 0], types[:, 1]
+            pairs += numpy.bincount(numpy.minimum(u, v) * layers + numpy.maximum(u, v), minlength=layers * layers)
+        self.layer_edges = pairs.reshape(layers, layers)
+
+    def as_dict(self):
+        return {
+            'vertices': self.vertices, 'edges': self.edges, 'isolated': self.isolated,
+            'layer_edges': self.layer_edges.tolist()
+        }
+
+    def __str__(self):
+        lines = ['Total number of edges: ' + str(self.edges)]
+        for layer, isolated in enumerate(self.isolated):
+            lines.append('Layer ' + str(layer) + ': ' + str(isolated) + ' vertices with no edges')
+        for l1 in range(len(self.vertices)):
+            for l2 in range(l1 + 1, len(self.vertices)):
+                lines.append('Sum edges layers ' + str(l1) + ' and ' + str(l2) + ' = ' + str(self.layer_edges[l1, l2]))
+        return '\n'.join(lines)
+
+
+class MGraph(object):
+    """
+    Compact n-partite graph. The adjacency is kept as CSR arrays (indptr,
+    indices, data), the layer of each vertex in a typed array, the predecessor
+    membership as flat offset-encoded arrays and the source membership as the
+    chain of successor arrays from the source graph (see source_arrays). An
+    igraph object is only built when the graph is exported (see to_igraph and
+    write).
+    """
+
+    def __init__(self, n=0):
+        self.attributes = {}
+        self.edges = numpy.empty((0, 2), dtype=numpy.int32)
+        self.edge_weight = numpy.empty(0)
+        self.add_vertices(n)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.get_weight(*key)
+        return self.attributes[key]
+
+    def __setitem__(self, key, value):
+        self.attributes[key] = value
+
+    def __delitem__(self, key):
+        del self.attributes[key]
+
+    def vcount(self):
+        return len(self.type)
+
+    def ecount(self):
+        return len(self.edges)
+
+    def add_vertices(self, n):
+        """
+        Reset the vertex arrays for n vertices, each one being its own source
+        and predecessor
+        """
+
+        self.type = numpy.zeros(n, dtype=numpy.int32)
+        self.weight = numpy.ones(n, dtype=numpy.int64)
+        self.name = numpy.arange(n, dtype=numpy.int64)
+        self.successor = numpy.full(n, -1, dtype=numpy.int64)
+        self.source_chain = []
+        self.source_ptr, self.source = None, None
+        self.predecessor_ptr = numpy.arange(n + 1, dtype=numpy.int64)
+        self.predecessor = numpy.arange(n, dtype=numpy.int64)
+        self.set_edges(self.edges[:0], self.edge_weight[:0])
+
+    def set_edges(self, edges, weights):
+        """
+        Set the edge list, in insertion order, and build the CSR adjacency.
+        Parallel edges are merged in the CSR, while degree and strength count
+        them, as igraph does. With a spill attribute (see external.Spill),
+        larger edge lists are memory-mapped and smaller ones promoted.
+        """
+
+        spill = self.attributes.get('spill')
+        if spill is not None:
+            if spill.spills(len(edges)):
+                return external.set_edges(self, edges, weights, spill)
+            edges, weights = external.promote(spill, edges), external.promote(spill, weights)
+        n = self.vcount()
+        dtype = numpy.int32 if n < numpy.iinfo(numpy.int32).max else numpy.int64
+        self.edges = numpy.asarray(edges, dtype=dtype).reshape(-1, 2)
+        self.edge_weight = numpy.asarray(weights)
+        u, v = self.edges[:, 0], self.edges[:, 1]
+        loop = u == v
+        rows = numpy.concatenate((u, v[~loop]))
+        cols = numpy.concatenate((v, u[~loop]))
+        data = numpy.concatenate((self.edge_weight, self.edge_weight[~loop]))
+        adjacency = sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+        adjacency.sum_duplicates()
+        self.indptr = adjacency.indptr.astype(numpy.int64)
+        self.indices = adjacency.indices.astype(dtype)
+        self.data = adjacency.data
+        self.degrees = numpy.bincount(self.edges.ravel(), minlength=n)
+        self.strengths = numpy.bincount(self.edges.ravel(), weights=numpy.repeat(self.edge_weight, 2), minlength=n)
+        self['adjlist'] = None
+
+    def set_edge_weights(self, weights):
+        """ Replace the edge weights keeping the edge list """
+
+        self.set_edges(self.edges, weights)
+
+    def adjacency(self):
+        """ Scipy CSR view of the adjacency, sharing the graph arrays """
+
+        n = self.vcount()
+        return sparse.csr_matrix((self.data, self.indices, self.indptr), shape=(n, n))
+
+    def adjacency_sets(self):
+        """ Neighbor sets of each vertex, built on demand for set-based similarity measures """
+
+        if self['adjlist'] is None:
+            self['adjlist'] = [set(self.neighbors(vertex)) for vertex in range(self.vcount())]
+        return self['adjlist']
+
+    def statistics(self):
+        return GraphStatistics(self)
+
+    def get_adjlist(self):
+        return [self.neighbors(vertex) for vertex in range(self.vcount())]
+
+    def get_edgelist(self):
+        return list(map(tuple, self.edges.tolist()))
+
+    def get_weight(self, i, j):
+        """ Weight of the edge (i, j), or 0 if the vertices are not adjacent """
+
+        start, end = self.indptr[i], self.indptr[i + 1]
+        index = start + numpy.searchsorted(self.indices[start:end], j)
+        if index < end and self.indices[index] == j:
+            return self.data[index].item()
+        return 0
+
+    def membership(self):
+        """ Vertex of each source vertex, composing the successor arrays of the chain """
+
+        result = numpy.arange(len(self.source_chain[0]) if self.source_chain else self.vcount())
+        for successor in self.source_chain:
+            result = successor[result]
+        return result
+
+    def source_arrays(self):
+        """
+        Source vertices of each vertex as offset-encoded arrays (source_ptr,
+        source), in the order of their predecessors at every level, i.e.,
+        sorted by their vertex at each level from this one down to the source
+        graph. They are resolved from the chain by one stable sort per level,
+        unless materialized by materialize_sources.
+        """
+
+        if self.source is not None:
+            return self.source_ptr, self.source
+        membership = numpy.arange(len(self.source_chain[0]) if self.source_chain else self.vcount())
+        order = membership
+        for successor in self.source_chain:
+            membership = successor[membership]
+            order = order[numpy.argsort(membership[order], kind='stable')]
+        counts = numpy.bincount(membership, minlength=self.vcount())
+        return numpy.concatenate(([0], numpy.cumsum(counts))), order
+
+    def materialize_sources(self):
+        """ Keep the source arrays, e.g., of the final level, for repeated queries """
+
+        self.source_ptr, self.source = self.source_arrays()
+
+    def get_source(self, vertex):
+        if self.source is None:
+            self.materialize_sources()
+        return self.source[self.source_ptr[vertex]:self.source_ptr[vertex + 1]]
+
+    def get_predecessor(self, vertex):
+        return self.predecessor[self.predecessor_ptr[vertex]:self.predecessor_ptr[vertex + 1]]
+
+    def neighbors(self, vertex):
+        return self.indices[self.indptr[vertex]:self.indptr[vertex + 1]].tolist()
+
+    def gather_neighbors(self, vertices):
+        """ Concatenation of the CSR rows of the given vertices, in the given order """
+
+        return gather(self.indptr, self.indices, vertices)
+
+    def gather_weights(self, vertices):
+        """ Edge weights aligned with gather_neighbors """
+
+        return gather(self.indptr, self.data, vertices)
+
+    def neighborhood(self, vertices=None, order=1, mindist=0):
+        """
+        Vertices reachable in at most `order` steps and at least `mindist`
+        steps, in breadth-first order, as igraph.Graph.neighborhood
+        """
+
+        if vertices is None:
+            vertices = range(self.vcount())
+        elif isinstance(vertices, (int, numpy.integer)):
+            return self._neighborhood(int(vertices), order, mindist)
+        return [self._neighborhood(vertex, order, mindist) for vertex in vertices]
+
+    def _neighborhood(self, vertex, order, mindist):
+        frontier = numpy.array([vertex], dtype=self.indices.dtype)
+        levels = [frontier]
+        visited = frontier
+        for _ in range(order):
+            candidates = self.gather_neighbors(frontier)
+            _, index = numpy.unique(candidates, return_index=True)
+            candidates = candidates[numpy.sort(index)]
+            frontier = candidates[~numpy.isin(candidates, visited)]
+            if len(frontier) == 0:
+                break
+            levels.append(frontier)
+            visited = numpy.concatenate((visited, frontier))
+        if len(levels) <= mindist:
+            return []
+        return numpy.concatenate(levels[mindist:]).tolist()
+
+    def hop_index(self, vertices, order, mindist=0, low=None, high=None, block=1024):
+        """
+        k-hop reachability index: the vertices at `mindist` to `order` steps
+        of each given vertex, in the breadth-first order of neighborhood, as
+        offset-encoded arrays (indptr, indices) aligned with vertices. Only
+        the vertices in [low, high], e.g., the layer, are indexed. The search
+        runs for a block of vertices at a time, keyed by (source, vertex).
+        """
+
+        n = self.vcount()
+        vertices = numpy.asarray(vertices, dtype=numpy.int64)
+        lengths = numpy.diff(self.indptr)
+        owners, indices = [], []
+        for start in range(0, len(vertices), block):
+            frontier = vertices[start:start + block]
+            owner = numpy.arange(start, start + len(frontier))
+            visited = numpy.sort(owner * n + frontier)
+            levels = [(owner, frontier)]
+            for _ in range(order):
+                candidates = self.gather_neighbors(frontier).astype(numpy.int64)
+                owner = numpy.repeat(owner, lengths[frontier])
+                keys = owner * n + candidates
+                _, index = numpy.unique(keys, return_index=True)
+                index.sort()
+                index = index[~numpy.isin(keys[index], visited, assume_unique=True)]
+                if len(index) == 0:
+                    break
+                owner, frontier = owner[index], candidates[index]
+                visited = numpy.union1d(visited, keys[index])
+                levels.append((owner, frontier))
+            levels = levels[mindist:]
+            if levels:
+                owner = numpy.concatenate([level[0] for level in levels])
+                frontier = numpy.concatenate([level[1] for level in levels])
+                keep = numpy.ones(len(frontier), dtype=bool)
+                if low is not None:
+                    keep &= frontier >= low
+                if high is not None:
+                    keep &= frontier <= high
+                order_by_owner = numpy.argsort(owner[keep], kind='stable')
+                owners.append(owner[keep][order_by_owner])
+                indices.append(frontier[keep][order_by_owner])
+
+        owner = numpy.concatenate(owners) if owners else numpy.empty(0, dtype=numpy.int64)
+        counts = numpy.bincount(owner, minlength=len(vertices))
+        indptr = numpy.concatenate(([0], numpy.cumsum(counts)))
+        return indptr, numpy.concatenate(indices) if indices else numpy.empty(0, dtype=numpy.int64)
+
+    def degree(self, vertices=None):
+        if vertices is None:
+            return self.degrees.tolist()
+        if isinstance(vertices, (int, numpy.integer)):
+            return int(self.degrees[vertices])
+        return self.degrees[list(vertices)].tolist()
+
+    def strength(self, vertices=None, weights=None):
+        if weights is None:
+            return self.degree(vertices)
+        if vertices is None:
+            return self.strengths.tolist()
+        if isinstance(vertices, (int, numpy.integer)):
+            return self.strengths[vertices].item()
+        return self.strengths[list(vertices)].tolist()
+
+    def copy(self):
+        """
+        Copy of the graph: the vertex arrays, which are updated in place by
+        contract, are duplicated; edges, CSR and attributes are shared
+        """
+
+        graph = MGraph.__new__(MGraph)
+        graph.__dict__.update(self.__dict__)
+        graph.attributes = dict(self.attributes)
+        graph.successor = self.successor.copy()
+        graph.weight = self.weight.copy()
+        return graph
+
+    def to_igraph(self):
+        """ Build an igraph object, e.g., to export the graph in GML or ncol """
+
+        graph = Graph(n=self.vcount(), edges=self.edges.tolist())
+        graph.es['weight'] = self.edge_weight.tolist()
+        graph.vs['type'] = self.type.tolist()
+        graph.vs['weight'] = self.weight.tolist()
+        graph.vs['successor'] = self.successor.tolist()
+        return graph
+
+    def write(self, filename, format=None):
+        self.to_igraph().write(filename, format=format)
+
+    def load(self, network_filename, vertices, filename_type='ncol', type_filename=None, cache=False, spill=None):
         """
         filename_type: ncol, arff
+        cache: reuse (or create) a binary sidecar of the parsed edge list
+        spill: out-of-core mode (see external.Spill), the edge list is
+        streamed to disk instead of the cache
         """
 
         edges, weights = None, None
         if filename_type == 'ncol':
-            edges, weights = load_ncol(network_filename)
+            if spill is not None:
+                edges, weights = external.spill_ncol(spill, read_ncol(network_filename))
+            else:
+                edges, weights = load_ncol(network_filename, cache=cache)
 
         self.add_vertices(sum(vertices))
-        self.add_edges(edges)
-        self['adjlist'] = list(map(set, self.get_adjlist()))
         self['vertices'] = vertices
         self['layers'] = len(vertices)
         self['level'] = [0] * self['layers']
         self['similarity'] = None
-        self.es['weight'] = weights
-        types = []
-        for layer in range(self['layers']):
-            types += [layer] * vertices[layer]
-        self.vs['type'] = types
-        for v in self.vs():
-            v['weight'] = 1
-            v['source'] = [v.index]
-            v['name'] = [v.index]
-            v['predecessor'] = [v.index]
-            v['successor'] = [None]
+        if spill is not None:
+            self['spill'] = spill
+        self.type = numpy.repeat(numpy.arange(self['layers'], dtype=numpy.int32), vertices)
+        self.set_edges(edges, weights)
+        self.set_vertices_by_type()
+
+    def set_vertices_by_type(self):
+        """ Vertex ids of each layer, which are contiguous since vertices are sorted by layer """
 
         self['vertices_by_type'] = []
+        start = 0
         for layer in range(self['layers']):
-            self['vertices_by_type'].append(self.vs.select(type=layer).indices)
-
-        # Not allow direct graphs
-        if self.is_directed():
-            self.to_undirected(combine_edges=None)
+            self['vertices_by_type'].append(list(range(start, start + self['vertices'][layer])))
+            start += self['vertices'][layer]
 
     def contract(self, matching):
         """
-        Create coarse graph from matching of groups
+        Create coarse graph from matching of groups. Vertices are grouped by
+        (layer, cluster) with a stable sort, so coarse vertices and
+        predecessors keep the order of the former per-cluster loop, and
+        parallel edges are merged with a single group-by over the successor
+        pairs, on disk for a spilled edge list. The coarse graph extends the
+        source chain by the successors, so no level copies the source vertices.
         """
 
+        n = self.vcount()
+        matching = numpy.asarray(matching)
+
         # Contract vertices: Referencing the original graph of the coarse graph
-        types = []
-        weights = []
-        sources = []
-        predecessors = []
-        matching = numpy.array(matching)
-        uniqid = 0
-        for layer in range(self['layers']):
-            start = sum(self['vertices'][0:layer])
-            end = sum(self['vertices'][0:layer + 1])
-            matching_layer = matching[start:end]
-            vertices_layer = numpy.arange(start, end)
-            clusters = numpy.unique(matching_layer)
-            for cluster_id in clusters:
-                ids = numpy.where(matching_layer == cluster_id)[0]
-                vertices = vertices_layer[ids]
-                weight = 0
-                source = []
-                predecessor = []
-                for vertex in vertices:
-                    self.vs[vertex]['successor'] = uniqid
-                    weight += self.vs[vertex]['weight']
-                    source.extend(self.vs[vertex]['source'])
-                    predecessor.append(vertex)
-                weights.append(weight)
-                types.append(layer)
-                sources.append(source)
-                predecessors.append(predecessor)
-                uniqid += 1
+        order = numpy.lexsort((matching, self.type))
+        boundary = numpy.ones(n, dtype=bool)
+        boundary[1:] = (self.type[order][1:] != self.type[order][:-1]) | (matching[order][1:] != matching[order][:-1])
+        starts = numpy.flatnonzero(boundary)
+        uniqid = len(starts)
+        self.successor[order] = numpy.cumsum(boundary) - 1
 
         # Create coarsened version
-        coarse = MGraph()
-        coarse.add_vertices(uniqid)
-        coarse.vs['type'] = types
-        coarse.vs['weight'] = weights
-        coarse.vs['name'] = range(coarse.vcount())
-        coarse.vs['successor'] = [None] * coarse.vcount()
-        coarse.vs['source'] = sources
-        coarse.vs['predecessor'] = predecessors
+        coarse = MGraph(uniqid)
+        coarse.type = self.type[order][starts]
+        coarse.weight = numpy.bincount(self.successor, weights=self.weight, minlength=uniqid).astype(numpy.int64)
+        coarse.predecessor_ptr = numpy.append(starts, n).astype(numpy.int64)
+        coarse.predecessor = order.astype(numpy.int64)
+        coarse.source_chain = self.source_chain + [self.successor.copy()]
         coarse['layers'] = self['layers']
         coarse['similarity'] = None
-        coarse['vertices'] = []
-
-        coarse['vertices_by_type'] = []
-        for layer in range(self['layers']):
-            coarse['vertices_by_type'].append(
-                coarse.vs.select(type=layer).indices)
-            coarse['vertices'].append(len(coarse['vertices_by_type'][layer]))
-
-        # Contract edges
-        dict_edges = dict()
-        for edge in self.es():
-            v_successor = self.vs[edge.tuple[0]]['successor']
-            u_successor = self.vs[edge.tuple[1]]['successor']
-
-            # Add edge in coarsened graph
-            if v_successor < u_successor:
-                dict_edges[(v_successor, u_successor)] = dict_edges.get(
-                    (v_successor, u_successor), 0) + edge['weight']
-            else:
-                dict_edges[(u_successor, v_successor)] = dict_edges.get(
-                    (u_successor, v_successor), 0) + edge['weight']
-        if len(dict_edges) > 0:
-            edges, weights = list(zip(*dict_edges.items()))
-            coarse.add_edges(edges)
-            coarse.es['weight'] = weights
-            coarse['adjlist'] = list(map(set, coarse.get_adjlist()))
+        if 'spill' in self.attributes:
+            coarse['spill'] = self['spill']
+        coarse['vertices'] = numpy.bincount(coarse.type, minlength=self['layers']).tolist()
+        coarse.set_vertices_by_type()
+
+        # Contract edges: parallel edges are summed in their original order
+        if isinstance(self.edges, numpy.memmap):
+            coarse.set_edges(*external.contract_edges(
+                self['spill'], self.edges, self.edge_weight, self.successor, uniqid))
+        elif self.ecount() > 0:
+            successors = self.successor[self.edges]
+            low, high = successors.min(axis=1), successors.max(axis=1)
+            _, first, inverse = numpy.unique(low * uniqid + high, return_index=True, return_inverse=True)
+            weights = numpy.bincount(inverse.ravel(), weights=self.edge_weight, minlength=len(first))
+            if self.edge_weight.dtype.kind in 'iu':
+                weights = weights.astype(self.edge_weight.dtype)
+            first_order = numpy.argsort(first)
+            edges = numpy.column_stack((low, high))[first[first_order]]
+            coarse.set_edges(edges, weights[first_order])
 
         return coarse
 
+    def two_hop_scores(self, vertices, similarity, same_set=False):
+        """
+        Score every two-hop pair of the given vertices with the batch engine
+        of the given (bound) similarity measure. A pair is reported once, from
+        the vertex that comes first in vertices, as the former per-vertex
+        visited loop; same_set restricts the pairs to vertices. The pairs of a
+        spilled edge list are written to disk block by block.
+        """
+
+        rank = numpy.full(self.vcount(), self.vcount(), dtype=numpy.int64)
+        rank[vertices] = numpy.arange(len(vertices))
+
+        def kept(rows, cols, scores):
+            keep = rank[cols] > rank[rows]
+            if same_set:
+                keep &= rank[cols] < self.vcount()
+            return rows[keep], cols[keep], scores[keep]
+
+        if not isinstance(self.edges, numpy.memmap):
+            return kept(*similarity.__self__.two_hops(vertices, similarity.__name__))
+        spill = self['spill']
+        writers = spill.writer(), spill.writer(), spill.writer()
+        for block in similarity.__self__.two_hop_blocks(vertices, similarity.__name__):
+            for writer, part in zip(writers, kept(*block)):
+                writer.append(part)
+        return tuple(writer.close() for writer in writers)
+
+    def two_hop_candidates(self, vertices, similarity):
+        """
+        Two-hop vertices of each given vertex with positive score, best first
+        and ties in breadth-first order, as offset-encoded arrays aligned with
+        vertices. The first unvisited candidate of a vertex is its rgmb match.
+        """
+
+        rows, cols, scores = similarity.__self__.two_hops(vertices, similarity.__name__)
+        keep = scores > 0
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+        position = numpy.zeros(self.vcount(), dtype=numpy.int64)
+        position[vertices] = numpy.arange(len(vertices))
+        order = numpy.lexsort((-scores, position[rows]))
+        counts = numpy.bincount(position[rows], minlength=len(vertices))
+        return numpy.concatenate(([0], numpy.cumsum(counts))), cols[order]
+
+    def hop_scores(self, vertices, similarity, hop, low, high):
+        """
+        Vertices at `hop` steps of each given vertex that lie in [low, high],
+        i.e., in its layer, and the mlpb similarity of each of these pairs
+        """
+
+        indptr, cols = self.hop_index(vertices, hop, hop, low, high)
+        rows = numpy.repeat(numpy.asarray(vertices, dtype=numpy.int64), numpy.diff(indptr))
+        scores = similarity.__self__.hops_pairs(self, hop, numpy.minimum(rows, cols), numpy.maximum(rows, cols))
+        neighborhoods = [chunk.tolist() for chunk in numpy.split(cols, indptr[1:-1])]
+        return neighborhoods, [chunk.tolist() for chunk in numpy.split(scores, indptr[1:-1])]
+
     def gmb(self, vertices=None, reduction_factor=0.5, reverse=True, gmv=None):
         """
         Matches are restricted between vertices that are not adjacent
@@ -197,23 +726,12 @@ class MGraph(Graph):
         matching = numpy.array([-1] * self.vcount())
         matching[vertices] = vertices
 
-        # Search two-hopes neighborhood for each vertex in selected layer
-        dict_edges = dict()
-        visited = [0] * self.vcount()
-        for vertex in vertices:
-            neighborhood = self.neighborhood(vertices=vertex, order=2)
-            twohops = neighborhood[(len(self['adjlist'][vertex]) + 1):]
-            for twohop in twohops:
-                if visited[twohop] == 1:
-                    continue
-                dict_edges[(vertex, twohop)] = self['similarity'](
-                    vertex, twohop)
-            visited[vertex] = 1
+        # Score the two-hopes neighborhood of every vertex in selected layer
+        # at once; each pair is kept once, from its first vertex
+        rows, cols, scores = self.two_hop_scores(vertices, self['similarity'])
 
         # Select promising matches or pair of vertices
         visited = [0] * self.vcount()
-        edges = sorted(dict_edges.items(),
-                       key=operator.itemgetter(1), reverse=reverse)
         merge_count = int(reduction_factor * len(vertices))
         if gmv is not None:
             while True:
@@ -221,25 +739,35 @@ class MGraph(Graph):
                     break
                 reduction_factor -= 0.01
                 merge_count = int(reduction_factor * len(vertices))
-        for edge, value in edges:
+        if isinstance(scores, numpy.memmap):
+            windows = external.best_pairs(rows, cols, scores, merge_count, reverse)
+        else:
+            windows = best_pairs(rows, cols, -scores if reverse else scores, merge_count)
+        for edges in windows:
+            for vertex, neighbor in edges:
+                if merge_count == 0:
+                    break
+                if (visited[vertex] != 1) and (visited[neighbor] != 1):
+                    matching[neighbor] = vertex
+                    matching[vertex] = vertex
+                    visited[neighbor] = 1
+                    visited[vertex] = 1
+                    merge_count -= 1
             if merge_count == 0:
                 break
-            vertex = edge[0]
-            neighbor = edge[1]
-            if (visited[vertex] != 1) and (visited[neighbor] != 1):
-                matching[neighbor] = vertex
-                matching[vertex] = vertex
-                visited[neighbor] = 1
-                visited[vertex] = 1
-                merge_count -= 1
+        if isinstance(scores, numpy.memmap):
+            self['spill'].release(rows, cols, scores)
 
         return matching
 
-    def rgmb(self, vertices=None, reduction_factor=0.5, seed_priority='random', reverse=True, gmv=None):
+    def rgmb(self, vertices=None, reduction_factor=0.5, seed_priority='random', reverse=True, gmv=None,
+             candidates=None):
         """
         Matches are restricted between vertices that are not adjacent
         but are only allowed to match with neighbors of its neighbors,
         i.e. two-hopes neighborhood. This version use a random seed.
+        candidates: function that ranks the two-hop candidates of the
+        vertices (see two_hop_candidates), e.g., split among workers
         """
 
         matching = numpy.array([-1] * self.vcount())
@@ -272,29 +800,30 @@ class MGraph(Graph):
                 reduction_factor -= 0.01
                 merge_count = int(reduction_factor * len(vertices))
 
+        # Rank the two-hop candidates of every vertex at once
+        # Tow hopes restriction: It ensures that the match only occurs
+        # between vertices of the same type
+        if candidates is None:
+            indptr, ranked = self.two_hop_candidates(vertices, self['similarity'])
+        else:
+            indptr, ranked = candidates(vertices)
+        position = numpy.zeros(self.vcount(), dtype=numpy.int64)
+        position[vertices] = numpy.arange(len(vertices))
+        position, indptr, ranked = position.tolist(), indptr.tolist(), ranked.tolist()
+
         while merge_count > 0 and index < len(vertices):
             # Randomly select a vertex v of V
             vertex = vertices_id[index]
             if visited[vertex] == 1:
                 index += 1
                 continue
-            # Select the edge (v, u) of E which maximum score
-            # Tow hopes restriction: It ensures that the match only occurs
-            # between vertices of the same type
-            neighborhood = self.neighborhood(vertices=vertex, order=2)
-            twohops = neighborhood[(len(self['adjlist'][vertex]) + 1):]
-            # twohops = set((twohop for onehop in self['adjlist'][vertex] for twohop in self['adjlist'][onehop])) -
-            # set([vertex])
-            _max = 0.0
+            # Select the edge (v, u) of E which maximum score, i.e., the
+            # first unvisited candidate
             neighbor = vertex
-            for twohop in twohops:
-                if visited[twohop] == 1:
-                    continue
-                # Calling a function of a module from a string
-                score = self['similarity'](vertex, twohop)
-                if score > _max:
-                    _max = score
+            for twohop in ranked[indptr[position[vertex]]:indptr[position[vertex] + 1]]:
+                if visited[twohop] != 1:
                     neighbor = twohop
+                    break
             matching[neighbor] = vertex
             matching[vertex] = vertex
             visited[neighbor] = 1
@@ -338,33 +867,30 @@ class MGraph(Graph):
         self.get_sorted_edges(merge_count, matching, reverse=False)
         return matching
 
-    def mnmf(self, reduction_factor=0.5, k=100, gmv=None):
+    def mnmf(self, reduction_factor=0.5, k=100, gmv=None, fit='projection', memory=None):
         """
-        Matching via non-negative matrix factorization
+        Matching via non-negative matrix factorization: heavy edge matching
+        with the edges weighted by the cosine of the factors of their ends.
+        fit: factorize the projection ('projection') or the rows of the layer
+        in the bipartite adjacency ('biadjacency'), which is much sparser
+        memory: budget in megabytes (None: unbounded); beyond it, factors are
+        fitted with mini-batch NMF and cosines computed in chunks of edges
         """
 
-        N = self.vcount()
-        edges = self.get_edgelist()
-        weights = self.es['weight']
-        X = sparse.csr_matrix((weights, zip(*edges)), shape=(N, N))
+        if fit == 'biadjacency':
+            bipartite, vertices = self['bipartite']
+            X = bipartite.adjacency()[vertices]
+            X = X[:, numpy.unique(X.indices)]
+        else:
+            N = self.vcount()
+            X = sparse.csr_matrix((self.edge_weight, (self.edges[:, 0], self.edges[:, 1])), shape=(N, N))
 
-        model = NMF(n_components=k, init='random', random_state=0,
-                    max_iter=200, tol=0.005, solver='mu')
-        W = model.fit_transform(X)
-        H = model.components_
-
-        weights = []
-        for edge in self.es():
-            a = W[edge.tuple[0]]
-            b = W[edge.tuple[1]]
-            if not numpy.count_nonzero(a) or not numpy.count_nonzero(b):
-                weights.append(0.0)
-                continue
-            cosine = 1 - spatial.distance.cosine(a, b)
-            weights.append(cosine)
+        budget = None if memory is None else memory * 2 ** 20
+        weights = numpy.zeros(self.ecount())
+        if X.nnz > 0:
+            weights = edge_cosine(nmf_factors(X, k, budget), self.edges, budget)
 
-        self.es['weight'] = weights
-        return self.hem(reduction_factor=reduction_factor, gmv=gmv)
+        return self.hem(reduction_factor=reduction_factor, gmv=gmv, weights=weights)
 
     def msvm(self, reduction_factor=0.5, gmv=None):
         """
@@ -406,8 +932,8 @@ class MGraph(Graph):
                     _max = score
                     neighbor = n
             # Match vertex and its neighbor with maximum score
-            matching[self.vs[neighbor]['name']] = self.vs[vertex]['name']
-            matching[self.vs[vertex]['name']] = self.vs[vertex]['name']
+            matching[self.name[neighbor]] = self.name[vertex]
+            matching[self.name[vertex]] = self.name[vertex]
             visited[neighbor] = 1
             visited[vertex] = 1
             merge_count -= 1
@@ -415,10 +941,10 @@ class MGraph(Graph):
 
         return matching
 
-    def hem(self, reduction_factor=0.5, gmv=None):
+    def hem(self, reduction_factor=0.5, gmv=None, weights=None):
         """
         Heavy Edge Matching: Search for a maximal matching using the
-        weights of the edges of the graph.
+        weights of the edges of the graph (or the given edge weights).
         """
 
         matching = numpy.array([-1] * self['source_vertices'])
@@ -429,7 +955,7 @@ class MGraph(Graph):
                     break
                 reduction_factor -= 0.01
                 merge_count = int(reduction_factor * self.vcount())
-        self.get_sorted_edges(merge_count, matching, reverse=True)
+        self.get_sorted_edges(merge_count, matching, reverse=True, weights=weights)
         return matching
 
     def get_random_edges(self, merge_count, matching):
@@ -438,41 +964,33 @@ class MGraph(Graph):
         of edges without common vertices random selected.
         """
 
-        visited = [0] * self.vcount()
-        edges = sample(list(self.es()), self.ecount())
-        for edge in edges:
-            if merge_count == 0:
-                break
-            if (visited[edge.tuple[0]] == 0) and (visited[edge.tuple[1]] == 0):
-                u = self.vs[edge.tuple[0]]['name']
-                v = self.vs[edge.tuple[1]]['name']
-                matching[u] = u
-                matching[v] = u
-                visited[edge.tuple[1]] = 1
-                visited[edge.tuple[0]] = 1
-                merge_count -= 1
+        order = numpy.array(random.sample(range(self.ecount()), self.ecount()), dtype=numpy.int64)
+        self.match_edges(order, merge_count, matching)
 
-    def get_sorted_edges(self, merge_count, matching, reverse=True):
+    def get_sorted_edges(self, merge_count, matching, reverse=True, weights=None):
         """
         Search for a maximal matching using the weights of the edges of
         the graph. The aim is to find a maximal matching of the graph that
         minimizes the cut.
         """
 
-        visited = [0] * self.vcount()
-        edges = sorted(
-            self.es(), key=lambda edge: edge['weight'], reverse=reverse)
-        for edge in edges:
-            if merge_count == 0:
-                break
-            if (visited[edge.tuple[0]] == 0) and (visited[edge.tuple[1]] == 0):
-                u = self.vs[edge.tuple[0]]['name']
-                v = self.vs[edge.tuple[1]]['name']
-                matching[u] = u
-                matching[v] = u
-                visited[edge.tuple[1]] = 1
-                visited[edge.tuple[0]] = 1
-                merge_count -= 1
+        if weights is None:
+            weights = self.edge_weight
+        # Stable, as sorted(reverse=True): ties keep the edge order
+        order = numpy.argsort(-weights if reverse else weights, kind='stable')
+        self.match_edges(order, merge_count, matching)
+
+    def match_edges(self, order, merge_count, matching):
+        """
+        Greedy matching over the edges in the given order, up to merge_count
+        pairs, each matched to the name of its first endpoint
+        """
+
+        edges = self.edges[order]
+        selected = greedy_matching(edges, self.vcount())[:max(merge_count, 0)]
+        u, v = self.name[edges[selected, 0]], self.name[edges[selected, 1]]
+        matching[u] = u
+        matching[v] = u
 
     def weighted_one_mode_projection(self, vertices, similarity='common_neighbors'):
         """
@@ -481,44 +999,40 @@ class MGraph(Graph):
         common neighbors are connected by edges in their respective projection.
         """
 
-        graph = MGraph()
-        graph.add_vertices(vertices)
+        graph = MGraph(len(vertices))
         graph['source_vertices'] = self.vcount()
         graph['source_edges'] = self.ecount()
-        graph.vs['name'] = self.vs[vertices]['name']
-        name_to_id = dict(zip(vertices, range(graph.vcount())))
-
-        dict_edges = dict()
-        visited = [0] * self.vcount()
-        for vertex in vertices:
-            neighborhood = self.neighborhood(vertices=vertex, order=2)
-            twohops = neighborhood[(len(self['adjlist'][vertex]) + 1):]
-            for twohop in twohops:
-                if visited[twohop] == 1:
-                    continue
-                dict_edges[(name_to_id[vertex], name_to_id[twohop])
-                           ] = self['projection'](vertex, twohop)
-            visited[vertex] = 1
-
-        if len(dict_edges) > 0:
-            edges, weights = list(zip(*dict_edges.items()))
-            graph.add_edges(edges)
-            graph.es['weight'] = weights
+        graph.name = self.name[vertices]
+        rows, cols, weights = self.two_hop_scores(vertices, self['projection'], same_set=True)
+        if len(rows) > 0:
+            name_to_id = numpy.full(self.vcount(), -1, dtype=numpy.int64)
+            name_to_id[vertices] = numpy.arange(len(vertices))
+            graph.set_edges(numpy.column_stack((name_to_id[rows], name_to_id[cols])), weights)
 
-        graph['adjlist'] = list(map(set, graph.get_adjlist()))
-        graph['similarity'] = getattr(Similarity(
-            graph, graph['adjlist']), similarity)
+        graph['similarity'] = getattr(Similarity(graph), similarity)
+        graph['bipartite'] = (self, vertices)
 
         return graph
 
     def mlpb(self, vertices=None, seed_priority='strength', reduction_factor=0.5, itr=10, tolerance=0.05,
-             upper_bound=0.2, n=None, gmv=None, reverse=True, hop=2):
-        """ Matching via weight-constrained label propagation and neighborhood. """
+             upper_bound=0.2, n=None, gmv=None, reverse=True, hop=2, prefetch=None, incremental=False, cache=None):
+        """
+        Matching via weight-constrained label propagation and neighborhood.
+        prefetch: function that computes the neighborhoods and similarities of
+        the vertices ahead of the sweeps (see hop_scores), e.g., split among
+        workers
+        incremental: after the first sweep, only visit the frontier, i.e., the
+        vertices whose last visit may no longer hold: the ones that moved, their
+        neighbors, and the members of the clusters they left and joined with
+        the neighbors of these members, whose capacity check has changed. The
+        others would keep their label, so the result is that of full sweeps.
+        cache: MatchingCache of the neighborhoods and similarities of this
+        graph, e.g., bounded and shared by the layers of a level
+        """
 
         # Getting the minimum and maximum vertex of this type
-        min_vertex = sorted(vertices)[0]
-        max_vertex = sorted(vertices)[-1]
-        print("min_vertex = ", min_vertex, "max_vertex = ", max_vertex)
+        min_vertex = min(vertices)
+        max_vertex = max(vertices)
 
         matching = numpy.array([-1] * self.vcount())
         matching[vertices] = vertices
@@ -530,23 +1044,21 @@ class MGraph(Graph):
             min_vertices = 1
 
         max_size = int(math.ceil(((1.0 + upper_bound) * n) / min_vertices))
-        print("n =", n)
-        print("upper_bound =", upper_bound)
-        print("min_vertices =", min_vertices)
-        print("max_size =", max_size)
 
         number_of_vertices = len(vertices)
-        weight_of_sv = self.vs['weight']
+        weight_of_sv = self.weight.tolist()
+        vertex_weight = self.weight.tolist()
         label_dict = dict(zip(vertices, vertices))
-        hops_dict = collections.defaultdict(int)
-        similarity_dict = collections.defaultdict(float)
+        if cache is None:
+            cache = MatchingCache()
+        hops_cache, similarity_cache = cache.hops, cache.similarity
 
-        print("number_of_vertices =", number_of_vertices)
-        print("weight_of_sv =", weight_of_sv)
-        print("label_dict =", label_dict)
-        # print("hops_dict =", hops_dict)
-        # print("similarity_dict =", similarity_dict)
-        print("tolerance starting with =", tolerance)
+        if prefetch is not None:
+            active = [vertex for vertex in vertices if self.degree(vertex) > 0]
+            for vertex, neighborhood, scores in zip(active, *prefetch(active, hop, min_vertex, max_vertex)):
+                hops_cache[vertex] = neighborhood
+                for neighbor, score in zip(neighborhood, scores):
+                    similarity_cache[(min(vertex, neighbor), max(vertex, neighbor))] = score
 
         # Select seed set expansion: case of strength or degree seed
         if seed_priority == 'strength':
@@ -561,58 +1073,79 @@ class MGraph(Graph):
             vertices_id = sorted(
                 dictionary, key=dictionary.__getitem__, reverse=reverse)
 
-        # print("vertices_score=", vertices_score)
-        # print("dictionary=", dictionary)
-        print("vertices_id=", vertices_id)
+        logger.debug('mlpb: vertices [%d, %d], n = %s, upper_bound = %s, min_vertices = %d, max_size = %d, '
+                     'tolerance = %s, itr = %d, hop = %d', min_vertex, max_vertex, n, upper_bound, min_vertices,
+                     max_size, tolerance, itr, hop)
 
         tolerance *= len(vertices)
-        print("tolerance now =", tolerance)
         swap = tolerance + 1
-        print("swap=", swap)
-        print("itr=", itr)
-
-        print("hop=", hop)
-
+        sweeps, swaps = 0, 0
+        hop_index, position = None, None
+        frontier, members = None, None
+        if incremental:
+            frontier = set(vertices)
+            members = {vertex: {vertex} for vertex in vertices}
+
+        def neighborhood_of(vertex):
+            """ Neighborhood generated by `hop` restriction, restricted to the
+            vertices of the same type by the k-hop index of the layer """
+
+            nonlocal hop_index, position
+            neighborhood = hops_cache.get(vertex)
+            if neighborhood is missing:
+                if hop_index is None:
+                    hop_index = self.hop_index(vertices, hop, hop, min_vertex, max_vertex)
+                    position = numpy.zeros(self.vcount(), dtype=numpy.int64)
+                    position[vertices] = numpy.arange(len(vertices))
+                start, end = hop_index[0][position[vertex]], hop_index[0][position[vertex] + 1]
+                neighborhood = hop_index[1][start:end].tolist()
+                hops_cache[vertex] = neighborhood
+            return neighborhood
+
+        has_path = False
         while (tolerance < swap) and itr:
             swap = 0
             itr -= 1
+            sweeps += 1
 
             # Select seed set expansion: case of random seed
             if seed_priority == 'random':
                 vertices_id = vertices
                 vertices_id = random.sample(vertices_id, len(vertices_id))
 
-            has_path = False
+            # The frontier is visited in the order of the full sweep, so that a
+            # vertex reached by a move earlier in this sweep is visited in it
+            visited = 0
             for vertex in vertices_id:
+                if frontier is not None:
+                    if vertex not in frontier:
+                        continue
+                    frontier.discard(vertex)
                 if self.degree(vertex) == 0:
-                    # print(f"*Vertex {vertex} has no connections (degree=0). Not possible to match. continue.")
                     continue
+                visited += 1
 
-                # Neighborhood generated by `hop` restriction
-                if not hops_dict.get(vertex, False):
-                    hops_dict[vertex] = self.neighborhood(
-                        vertices=vertex, order=hop, mindist=hop)
-                    # Cleaning hops_dict[vertex]:
-                    # Ensuring the neighborhood contains only vertex from the same type
-                    hops_dict[vertex] = [neighbor for neighbor in hops_dict[vertex]
-                                         if neighbor >= min_vertex and neighbor <= max_vertex]
+                neighborhood = neighborhood_of(vertex)
+
+                # Similarities of the neighborhood, the ones not cached scored in one batch
+                keys = [(min(vertex, neighbor), max(vertex, neighbor)) for neighbor in neighborhood]
+                similarities = [similarity_cache.get(key) for key in keys]
+                absent = [index for index, similarity in enumerate(similarities) if similarity is missing]
+                if absent:
+                    pairs = numpy.array([keys[index] for index in absent], dtype=numpy.int64)
+                    scores = self['similarity'].__self__.hops_pairs(self, hop, pairs[:, 0], pairs[:, 1]).tolist()
+                    for index, similarity in zip(absent, scores):
+                        similarities[index] = similarity
+                        similarity_cache[keys[index]] = similarity
 
                 # Update neighborhood edge density
                 Q = collections.defaultdict(float)
-                for neighbor in hops_dict[vertex]:
+                for neighbor, similarity in zip(neighborhood, similarities):
                     has_path = True
                     # supervertex weight restriction
-                    if weight_of_sv[label_dict[neighbor]] + self.vs[vertex]['weight'] <= max_size:
-                        u = min(vertex, neighbor)
-                        v = max(vertex, neighbor)
-                        if not similarity_dict.get((u, v), False):
-                            similarity_dict[(u, v)] = self['similarity'](
-                                self, hop, u, v)
-                        if similarity_dict[(u, v)] > 0.0:
-                            Q[label_dict[neighbor]] += similarity_dict[(u, v)]
-                    # else:
-                    #     print(
-                    #         f"Maximum supervertex size reached ({max_size}). Vertex ({vertex}) weight = ({self.vs[vertex]['weight']}). label_dict[vertex {vertex}] ({label_dict[vertex]}). label_dict[neighbor {neighbor}] ({label_dict[neighbor]}) weight = ({weight_of_sv[label_dict[neighbor]]})")
+                    if weight_of_sv[label_dict[neighbor]] + vertex_weight[vertex] <= max_size:
+                        if similarity > 0.0:
+                            Q[label_dict[neighbor]] += similarity
 
                 total_similarity = sum(Q.values())
                 # `li` similarity subtracted by the similarity of others
@@ -628,33 +1161,51 @@ class MGraph(Graph):
                     # and update data structures
                     if dominant_label != prev_label:
                         swap += 1
+                        if incremental:
+                            # The vertex, its neighbors, and the members of both
+                            # clusters and their neighbors, which see new weights
+                            changed = members[prev_label] | members[dominant_label]
+                            members[prev_label].discard(vertex)
+                            members[dominant_label].add(vertex)
+                            frontier.update(neighborhood)
+                            frontier.update(changed)
+                            for member in changed:
+                                frontier.update(neighborhood_of(member))
                         # Update vertex label
                         label_dict[vertex] = dominant_label
                         # Update the super-vertex weight
-                        weight_of_sv[prev_label] -= self.vs[vertex]['weight']
-                        weight_of_sv[dominant_label] += self.vs[vertex]['weight']
+                        weight_of_sv[prev_label] -= vertex_weight[vertex]
+                        weight_of_sv[dominant_label] += vertex_weight[vertex]
                         # Verify the size-constraint restriction
                         if weight_of_sv[prev_label] == 0:
                             number_of_vertices -= 1
                         if number_of_vertices <= min_vertices:
                             tolerance = swap
-                            print(
-                                f"Minimum number of vertices reached with {number_of_vertices} vertices.")
+                            logger.debug('mlpb: minimum number of vertices reached with %d vertices',
+                                         number_of_vertices)
                             break
+            swaps += swap
+            logger.debug('mlpb: sweep %d, %d vertices, %d swaps, %d labels', sweeps, visited, swap,
+                         number_of_vertices)
 
-        print("----> itr =", itr)
         if not has_path:
-            print(
-                f"No paths of {hop}-hops found anymore (hops_dict is null for all vertices).")
+            stop = 'no %d-hop paths' % hop
         elif swap == 0:
-            print(
-                "Swap == 0. Dominant label are already stabilized, no changes detected.")
+            stop = 'labels stabilized'
+        elif number_of_vertices <= min_vertices:
+            stop = 'minimum number of vertices'
+        elif itr == 0:
+            stop = 'maximum iterations'
+        else:
+            stop = 'tolerance'
+        logger.info('mlpb: %d sweeps, %d swaps, %d of %d labels left (%s)', sweeps, swaps, number_of_vertices,
+                    len(vertices), stop)
+        logger.debug('mlpb: %s', cache)
         for key, value in label_dict.items():
             matching[key] = value
 
         return matching
 
     def number_of_components(self):
-        components = self.components()
-        components_sizes = components.sizes()
-        return len(components_sizes)
+        n_components, _ = csgraph.connected_components(self.adjacency(), directed=False)
+        return n_components
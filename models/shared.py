@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Shared memory graph
+
+Copyright (C) 2020 Alan Valejo <alanvalejo@gmail.com> All rights reserved
+
+This program comes with ABSOLUTELY NO WARRANTY. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS
+WITH YOU.
+
+Owner or contributors are not liable for any direct, indirect, incidental, special, exemplary, or consequential
+damages, (such as loss of data or profits, and others) arising in any way out of the use of this software,
+even if advised of the possibility of such damage.
+
+This program is free software and distributed in the hope that it will be useful: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with this program. If not,
+see http://www.gnu.org/licenses/.
+
+Giving credit to the author by citing the papers.
+"""
+
+import os
+import numpy
+import multiprocessing as mp
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from models.mgraph import MGraph
+
+__maintainer__ = 'Alan Valejo'
+__email__ = 'alanvalejo@gmail.com'
+__author__ = 'Alan Valejo'
+__credits__ = ['Alan Valejo']
+__homepage__ = 'https://www.alanvalejo.com.br'
+__license__ = 'GNU.GPL.v3'
+__docformat__ = 'markdown en'
+__version__ = '0.1'
+__date__ = '2020-05-05'
+
+# Arrays read by the matching methods; memberships stay in the parent process
+shared_arrays = ['indptr', 'indices', 'data', 'edges', 'edge_weight', 'degrees', 'strengths', 'type', 'weight', 'name']
+shared_attributes = ['vertices', 'layers', 'level', 'spill']
+
+# Graph attached by this (worker) process and its memory blocks
+attached = {'key': None, 'graph': None, 'blocks': []}
+
+
+class SharedGraph(object):
+    """
+    Publishes the arrays of a graph in shared memory blocks. The descriptor
+    (block names, dtypes and shapes) and the small attributes are all that is
+    sent to the workers, which attach to the blocks without copying them.
+    Memory-mapped arrays (see external.Spill) are described by their file.
+    """
+
+    def __init__(self, graph):
+        self.blocks = []
+        self.descriptor = {}
+        for key in shared_arrays:
+            array = getattr(graph, key)
+            if isinstance(array, numpy.memmap):
+                self.descriptor[key] = (array.filename, array.dtype.str, array.shape)
+                continue
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.descriptor[key] = (block.name, array.dtype.str, array.shape)
+        self.attributes = {key: graph.attributes.get(key) for key in shared_attributes}
+        self.source = (self.descriptor, self.attributes)
+
+    def release(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def worker_pool(processes):
+    """
+    Pool of workers sharing the resource tracker of this process, which must
+    be running before they start: the blocks they attach to are then released
+    by the unlink of their creator instead of being reported as leaked.
+    """
+
+    if shared_memory is not None:
+        resource_tracker.ensure_running()
+    return mp.Pool(processes=processes)
+
+
+def open_block(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        return shared_memory.SharedMemory(name=name)
+
+
+def detach():
+    """ Drop the graph attached by this process and close its blocks """
+
+    # The similarity closures refer back to the graph: clearing the attributes
+    # breaks the cycle, so the array views are freed before closing the blocks
+    if attached['graph'] is not None:
+        attached['graph'].attributes.clear()
+    attached['graph'] = None
+    for block in attached['blocks']:
+        try:
+            block.close()
+        except BufferError:
+            pass
+    attached.update(key=None, blocks=[])
+
+
+def attach(descriptor, attributes):
+    """
+    Graph backed by the shared blocks of the descriptor. It is kept while the
+    same level is being matched, so the set-based structures built on it by
+    a worker are reused by its next tasks.
+    """
+
+    key = tuple(name for name, _, _ in descriptor.values())
+    if attached['key'] == key:
+        return attached['graph']
+
+    detach()
+    graph = MGraph.__new__(MGraph)
+    graph.attributes = dict(attributes)
+    blocks = []
+    for array_name, (name, dtype, shape) in descriptor.items():
+        if os.path.isabs(name):
+            setattr(graph, array_name, numpy.memmap(name, dtype=numpy.dtype(dtype), mode='r', shape=shape))
+            continue
+        block = open_block(name)
+        setattr(graph, array_name, numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=block.buf))
+        blocks.append(block)
+    graph['adjlist'] = None
+    graph['similarity'] = None
+    graph.set_vertices_by_type()
+    attached.update(key=key, graph=graph, blocks=blocks)
+    return graph
+
+
+def task_graph(source):
+    """ Graph of a task: the graph itself or the source of a shared graph """
+
+    if isinstance(source, MGraph):
+        return source
+    return attach(*source)
@@ -23,6 +23,10 @@ Giving credit to the author by citing the papers.
 """
 
 import math
+import numpy
+import logging
+
+from models import lsh
 
 from numpy import dot
 from numpy.linalg import norm
@@ -38,14 +42,442 @@ __docformat__ = 'markdown en'
 __version__ = '0.1'
 __date__ = '2020-05-05'
 
+logger = logging.getLogger(__name__)
+
+
+# Set bits of each byte, for numpy without bitwise_count
+byte_bits = numpy.array([bin(byte).count('1') for byte in range(256)], dtype=numpy.int64)
+
+
+def popcount(words):
+    """ Number of set bits of each row (last axis) of an array of uint64 words """
+
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(words).sum(axis=-1, dtype=numpy.int64)
+    return byte_bits[words.view(numpy.uint8)].sum(axis=-1)
+
+
+def group_sum(groups, terms, size):
+    """
+    Sum of the terms of each group, correctly rounded as math.fsum gives,
+    so that it does not depend on the order of the terms: the batch engines
+    and the pairwise measures then score a pair identically and exact ties
+    stay ties. The terms are split twice at a power of two above twice the
+    group's absolute sum, so that both high parts add up exactly; math.fsum
+    is only called for the groups whose remainders leave the rounding in doubt.
+    """
+
+    groups = numpy.asarray(groups, dtype=numpy.int64)
+    terms = numpy.asarray(terms, dtype=float)
+    counts = numpy.bincount(groups, minlength=size)
+    with numpy.errstate(invalid='ignore', over='ignore'):
+        sums, rest = [], terms
+        for level in range(2):
+            scale = numpy.bincount(groups, weights=numpy.abs(rest), minlength=size)
+            scale = numpy.ldexp(1.0, numpy.frexp(scale)[1] + 1)[groups]
+            high = (scale + rest) - scale
+            sums.append(numpy.bincount(groups, weights=high, minlength=size))
+            rest = rest - high
+        bound = numpy.bincount(groups, weights=numpy.abs(rest), minlength=size)
+
+        # Two-sum of the exact high sums: the rounded sum and its exact residual
+        result = sums[0] + sums[1]
+        virtual = result - sums[0]
+        residual = (sums[0] - (result - virtual)) + (sums[1] - virtual)
+        step = numpy.where(residual * result > 0,
+                           numpy.nextafter(result, numpy.copysign(numpy.inf, result)) - result,
+                           result - numpy.nextafter(result, 0.0))
+        doubtful = ~(numpy.abs(residual) + 2 * bound < numpy.abs(step) / 2)
+        doubtful &= bound > 0
+        doubtful |= ~numpy.isfinite(result)
+    if doubtful.any():
+        listed = numpy.flatnonzero(doubtful[groups])
+        listed = listed[numpy.argsort(groups[listed], kind='stable')]
+        doubtful = numpy.flatnonzero(doubtful)
+        starts = numpy.searchsorted(groups[listed], doubtful)
+        for group, part in zip(doubtful.tolist(), numpy.split(terms[listed], starts[1:])):
+            result[group] = math.fsum(part.tolist())
+    return result
+
 
 class Similarity(object):
 
     graph, adjlist = (None,) * 2
 
-    def __init__(self, graph, adjlist):
+    # Measures scored by the batch two-hop engine, see two_hops
+    batch_measures = [
+        'common_neighbors', 'weighted_common_neighbors', 'jaccard', 'salton', 'sorensen', 'hub_promoted',
+        'hub_depressed', 'leicht_holme_newman', 'preferential_attachment', 'adamic_adar', 'resource_allocation',
+        'newman_collaboration', 'unweight', 'weighted_jaccard'
+    ]
+
+    # Measures whose batch score sums the weights of the two-hop paths
+    weighted_measures = ['weighted_common_neighbors', 'weighted_jaccard']
+
+    # Measures of the number of common neighbors and the degrees only, scored
+    # from the bitsets by score_pairs
+    count_measures = [
+        'common_neighbors', 'jaccard', 'salton', 'sorensen', 'hub_promoted', 'hub_depressed', 'leicht_holme_newman',
+        'preferential_attachment', 'unweight'
+    ]
+
+    # Automatic backend of score_pairs: bitsets for graphs up to bitset_vertices
+    # vertices whose bitsets take less memory than the neighbor sets, estimated
+    # as set_bytes per set plus entry_bytes per neighbor (slots and int objects)
+    bitset_vertices = 2 ** 18
+    set_bytes, entry_bytes = 216, 64
+
+    def __init__(self, graph, adjlist=None, lsh=None, hubs=None, backend='auto', engine='batch'):
+        """
+        adjlist: neighbor sets of the vertices, built on demand if not given
+        lsh: options of lsh.candidates (top_k, threshold, num_perm, seed);
+        when given, two_hops scores the approximate most similar pairs of
+        the vertices instead of every two-hop pair
+        hubs: options of the hub cap of two_hops (degree or percentile, mode
+        'skip' or 'sample', sample, seed), see second_hop
+        backend: adjacency of the pairwise intersections, 'sets', 'bitsets'
+        (packed rows of uint64 words) or 'auto' (chosen by density)
+        engine: 'batch' scores the batch measures with the vectorized engines,
+        'pairwise' calls the measure on each pair, as their reference
+        """
+
         self.graph = graph
         self.adjlist = adjlist
+        self.lsh = lsh
+        self.hubs = hubs
+        self.backend = backend
+        self.engine = engine
+        self.bits = None
+        self.hop = None
+        self.keys = None
+        self.balls = {}
+        self.indptr = None
+        self.degree, self.strength, self.log_degree, self.inverse_degree, self.neighbor_count = (None,) * 5
+        # Counters: two-hop candidate pairs, pairs scored by the batch engines
+        # and two-hop paths pruned through hubs
+        self.candidates, self.evaluations, self.pruned = 0, 0, 0
+
+    def refresh(self):
+        """
+        Per-vertex arrays read by the measures: degree and strength, from
+        the graph, where an edge listed in both directions counts twice as in
+        igraph, log-degree, inverse degree (inf where the degree is 0) and the
+        number of distinct neighbors, the size of the neighbor set that jaccard
+        unions. They are built once per graph and rebuilt, with the other
+        cached arrays, whenever the graph is given new edges, e.g., a new level
+        by contract.
+        """
+
+        if self.indptr is not self.graph.indptr:
+            if self.indptr is not None:
+                self.adjlist = None
+            self.indptr = self.graph.indptr
+            self.degree = numpy.asarray(self.graph.degrees, dtype=float)
+            self.neighbor_count = numpy.diff(self.indptr).astype(float)
+            self.strength = numpy.asarray(self.graph.strengths, dtype=float)
+            with numpy.errstate(divide='ignore'):
+                self.log_degree = numpy.log(self.degree)
+                self.inverse_degree = 1 / self.degree
+            self.hop, self.keys, self.balls, self.bits = None, None, {}, None
+
+    def adjacency_backend(self, batch=False):
+        """
+        Backend of the intersections of the graph: the given one or, with
+        'auto', the smallest one for batches of pairs. Single pairs stay on
+        the sets with 'auto', as a numpy call per pair costs more than the
+        intersection of two small sets.
+        """
+
+        if self.backend != 'auto':
+            return self.backend
+        if not batch:
+            return 'sets'
+        n = self.graph.vcount()
+        if n > self.bitset_vertices:
+            return 'sets'
+        bitset_bytes = n * ((n + 63) // 64) * 8
+        return 'bitsets' if bitset_bytes <= n * self.set_bytes + 2 * self.graph.ecount() * self.entry_bytes else 'sets'
+
+    def neighbor_sets(self):
+        """ Neighbor sets of the vertices (sets backend) """
+
+        if self.adjlist is None:
+            self.adjlist = self.graph.adjacency_sets()
+        return self.adjlist
+
+    def bitsets(self):
+        """ Neighbors of each vertex as a packed row of bits, vertex z being bit z % 64 of word z // 64 """
+
+        self.refresh()
+        if self.bits is None:
+            graph = self.graph
+            n = graph.vcount()
+            self.bits = numpy.zeros((n, (n + 63) // 64), dtype=numpy.uint64)
+            owner = numpy.repeat(numpy.arange(n), numpy.diff(graph.indptr))
+            indices = graph.indices.astype(numpy.int64)
+            numpy.bitwise_or.at(self.bits, (owner, indices >> 6),
+                                numpy.left_shift(numpy.uint64(1), (indices & 63).astype(numpy.uint64)))
+        return self.bits
+
+    def common(self, i, j):
+        """ Common neighbors of i and j, as a set or, with bitsets, a sorted array """
+
+        self.refresh()
+        if self.adjacency_backend() == 'bitsets':
+            bits = self.bitsets()
+            return numpy.flatnonzero(numpy.unpackbits((bits[i] & bits[j]).view(numpy.uint8), bitorder='little'))
+        sets = self.neighbor_sets()
+        return sets[i].intersection(sets[j])
+
+    def common_count(self, i, j):
+        """ Number of common neighbors of i and j """
+
+        self.refresh()
+        if self.adjacency_backend() == 'bitsets':
+            bits = self.bitsets()
+            return int(popcount(bits[i] & bits[j]))
+        sets = self.neighbor_sets()
+        return len(sets[i].intersection(sets[j]))
+
+    def second_hop(self):
+        """
+        CSR arrays (indptr, indices) through which two_hops takes its second
+        step, and the hub mask. Hubs are the vertices whose degree is above
+        hubs['degree'], or above the hubs['percentile'] of the degrees; their
+        rows are emptied (mode 'skip') or reduced to a fixed random sample of
+        hubs['sample'] neighbors, by default the cap itself (mode 'sample').
+        """
+
+        self.refresh()
+        if self.hop is None:
+            graph = self.graph
+            lengths = numpy.diff(graph.indptr)
+            cap = self.hubs.get('degree')
+            if cap is None:
+                cap = numpy.percentile(lengths[lengths > 0], self.hubs['percentile']) if lengths.any() else 0
+            hub = lengths > cap
+            owner = numpy.repeat(numpy.arange(graph.vcount()), lengths)
+            keep = ~hub[owner]
+            if self.hubs.get('mode', 'skip') == 'sample':
+                sample = self.hubs.get('sample') or int(cap)
+                random = numpy.random.RandomState(self.hubs.get('seed', 0)).random_sample(len(owner))
+                order = numpy.lexsort((random, owner))
+                rank = numpy.empty(len(owner), dtype=numpy.int64)
+                rank[order] = numpy.arange(len(owner)) - graph.indptr[owner[order]]
+                keep |= rank < sample
+            counts = numpy.bincount(owner[keep], minlength=graph.vcount())
+            self.hop = (numpy.concatenate(([0], numpy.cumsum(counts))), graph.indices[keep], hub)
+        return self.hop
+
+    def hop_neighbors(self, vertices):
+        """ Concatenation of the second_hop rows of the given vertices """
+
+        indptr, indices, _ = self.second_hop()
+        starts = indptr[vertices]
+        counts = indptr[vertices + 1] - starts
+        return indices[numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())]
+
+    def two_hops(self, vertices, measure='common_neighbors', max_paths=2 ** 24):
+        """
+        Batch engine: scores every pair (v, u) such that v is in vertices and u
+        is at distance two of v. The two-hop paths v - z - u of a block of
+        vertices are expanded at once from the CSR arrays and grouped by
+        (v, u), i.e., the nonzeros of B B^T, where the path count gives the
+        common neighbors and the degree arrays give the normalisation.
+        Pairs of each vertex come in breadth-first order, as in
+        neighborhood(order=2, mindist=2), and at most max_paths paths are
+        expanded at a time. Returns COO arrays (rows, cols, scores).
+        With hubs, paths through hubs are skipped or sampled (see second_hop),
+        so a hub no longer pairs all its neighbors; the pairs left are scored
+        exactly by score_pairs, and the pruned paths are counted in pruned.
+        """
+
+        blocks = list(self.two_hop_blocks(vertices, measure, max_paths))
+        if not blocks:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64), numpy.empty(0)
+        return tuple(numpy.concatenate(parts) for parts in zip(*blocks))
+
+    def two_hop_blocks(self, vertices, measure='common_neighbors', max_paths=2 ** 24):
+        """ Pairs of two_hops as (rows, cols, scores), one block at a time """
+
+        graph = self.graph
+        if self.lsh is not None:
+            # Buckets span the whole layers of the vertices, so that a chunk of
+            # a layer gets the same candidates as the layer itself
+            vertices = numpy.asarray(vertices, dtype=numpy.int64)
+            layers = numpy.unique(graph.type[vertices])
+            members = numpy.concatenate([graph['vertices_by_type'][layer] for layer in layers]).astype(numpy.int64)
+            rows, cols, _ = lsh.candidates(graph, members, **self.lsh)
+            position = numpy.full(graph.vcount(), -1, dtype=numpy.int64)
+            position[vertices] = numpy.arange(len(vertices))
+            keep = numpy.flatnonzero(position[rows] >= 0)
+            keep = keep[numpy.argsort(position[rows[keep]], kind='stable')]
+            rows, cols = rows[keep], cols[keep]
+            self.candidates += len(rows)
+            yield rows, cols, self.score_pairs(rows, cols, measure, max_paths)
+            return
+
+        n = graph.vcount()
+        vertices = numpy.asarray(vertices, dtype=numpy.int64)
+        lengths = numpy.diff(graph.indptr)
+        hop_lengths, capped, pruned = lengths, False, 0
+        if self.hubs is not None:
+            hop_indptr, _, hub = self.second_hop()
+            hop_lengths, capped = numpy.diff(hop_indptr), hub.any()
+        paths = numpy.concatenate(([0], numpy.cumsum(hop_lengths[graph.indices])))
+        paths = (paths[graph.indptr[1:]] - paths[graph.indptr[:-1]])[vertices]
+        bounds = numpy.concatenate(([0], numpy.cumsum(paths)))
+
+        start = 0
+        while start < len(vertices):
+            end = max(start + 1, numpy.searchsorted(bounds, bounds[start] + max_paths, side='right') - 1)
+            block = vertices[start:end]
+            start = end
+
+            # One-hop (v, z) and two-hop (v, z, u) expansion of the block
+            first = graph.gather_neighbors(block)
+            first_weights = graph.gather_weights(block)
+            owner = numpy.repeat(numpy.arange(len(block)), lengths[block])
+            second = self.hop_neighbors(first) if capped else graph.gather_neighbors(first)
+            counts = hop_lengths[first]
+            pruned += int((lengths[first] - counts).sum())
+            path_owner = numpy.repeat(owner, counts)
+            path_middle = numpy.repeat(first, counts)
+            keys = path_owner * n + second
+
+            # Distance two only: neither the vertex itself nor its neighbors
+            keep = (second != block[path_owner]) & ~numpy.isin(keys, owner * n + first)
+            keys, path_middle = keys[keep], path_middle[keep]
+            _, index, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+            inverse = inverse.ravel()
+            order = numpy.argsort(index, kind='stable')
+            row = block[path_owner[keep][index]]
+            col = second[keep][index]
+
+            if capped:
+                score = self.score_pairs(row, col, measure, max_paths)
+            elif measure in self.batch_measures and self.engine == 'batch':
+                weights = None
+                if measure in self.weighted_measures:
+                    weights = (numpy.repeat(first_weights, counts)[keep] + graph.gather_weights(first)[keep]) / 2
+                score = self.batch_score(measure, row, col, path_middle, inverse, len(index), weights)
+            else:
+                function = getattr(self, measure)
+                score = numpy.array([function(i, j) for i, j in zip(row.tolist(), col.tolist())])
+
+            self.candidates += len(row)
+            if not capped:
+                self.evaluations += len(row)
+            yield row[order], col[order], score[order]
+
+        if capped and len(vertices):
+            self.pruned += pruned
+            logger.info('Two-hop expansion of %d vertices: %d paths through %d hubs pruned',
+                        len(vertices), pruned, numpy.count_nonzero(hub))
+
+    def score_pairs(self, rows, cols, measure='common_neighbors', max_paths=2 ** 24):
+        """
+        Batch engine for given pairs (i, j): the common neighbors z are found
+        by looking up every edge (i, z) of the end with the lowest degree among
+        the sorted keys z * n + j of the CSR edges, at most max_paths at a time
+        """
+
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        cols = numpy.asarray(cols, dtype=numpy.int64)
+        self.evaluations += len(rows)
+        if measure not in self.batch_measures or self.engine == 'pairwise':
+            function = getattr(self, measure)
+            return numpy.array([function(i, j) for i, j in zip(rows.tolist(), cols.tolist())], dtype=float)
+
+        self.refresh()
+        if measure in self.count_measures and self.adjacency_backend(batch=True) == 'bitsets':
+            # AND of the rows of max_paths words at a time
+            bits = self.bitsets()
+            step = max(1, max_paths // bits.shape[1])
+            scores = [self.batch_score(measure, rows[start:start + step], cols[start:start + step], None, None,
+                                       len(rows[start:start + step]),
+                                       isect=popcount(bits[rows[start:start + step]] & bits[cols[start:start + step]]))
+                      for start in range(0, len(rows), step)]
+            return numpy.concatenate(scores).astype(float) if scores else numpy.empty(0)
+
+        self.refresh()
+        graph = self.graph
+        n = graph.vcount()
+        lengths = numpy.diff(graph.indptr)
+        if self.keys is None:
+            # Sorted keys z * n + j of the CSR edges, shared by the calls on this graph
+            self.keys = numpy.repeat(numpy.arange(n, dtype=numpy.int64), lengths) * n + graph.indices
+        keys = self.keys
+        low = numpy.where(lengths[rows] <= lengths[cols], rows, cols)
+        high = numpy.where(lengths[rows] <= lengths[cols], cols, rows)
+        bounds = numpy.concatenate(([0], numpy.cumsum(lengths[low])))
+
+        scores = []
+        start = 0
+        while start < len(rows):
+            end = max(start + 1, numpy.searchsorted(bounds, bounds[start] + max_paths, side='right') - 1)
+            pair = numpy.repeat(numpy.arange(end - start), lengths[low[start:end]])
+            middle = graph.gather_neighbors(low[start:end]).astype(numpy.int64)
+            position = numpy.minimum(numpy.searchsorted(keys, middle * n + high[start:end][pair]), len(keys) - 1)
+            found = keys[position] == middle * n + high[start:end][pair]
+            weights = None
+            if measure in self.weighted_measures:
+                weights = (graph.gather_weights(low[start:end])[found] + graph.data[position[found]]) / 2
+            scores.append(self.batch_score(
+                measure, rows[start:end], cols[start:end], middle[found], pair[found], end - start, weights))
+            start = end
+
+        if not scores:
+            return numpy.empty(0)
+        return numpy.concatenate(scores).astype(float)
+
+    def batch_score(self, measure, row, col, middle, inverse, size, weights=None, isect=None):
+        """
+        Vectorized version of a pairwise measure for grouped two-hop paths,
+        where inverse maps each path (through the middle vertex) to its pair,
+        or for pairs whose common neighbors are counted in isect
+        """
+
+        self.refresh()
+        degree = self.degree
+        if isect is None:
+            isect = numpy.bincount(inverse, minlength=size)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            if measure == 'unweight':
+                return numpy.ones(size)
+            if measure == 'common_neighbors':
+                return isect
+            if measure == 'weighted_common_neighbors':
+                return group_sum(inverse, weights, size)
+            if measure == 'weighted_jaccard':
+                # The other neighbors weigh the mean strength minus the common ones
+                isect = group_sum(inverse, weights, size)
+                union = (self.strength[row] + self.strength[col]) / 2 - isect
+                return numpy.where(union == 0.0, 0.0, isect / union)
+            if measure == 'newman_collaboration':
+                return group_sum(inverse, 1 / (degree[middle] - 1), size)
+            if measure == 'adamic_adar':
+                return group_sum(inverse, 1 / self.log_degree[middle], size)
+            if measure == 'resource_allocation':
+                return group_sum(inverse, self.inverse_degree[middle], size)
+            if measure == 'jaccard':
+                union = self.neighbor_count[row] + self.neighbor_count[col] - isect
+                return numpy.where(union == 0, 0, isect / union.astype(float))
+            if measure == 'preferential_attachment':
+                return degree[row] * degree[col]
+            product = degree[row] * degree[col]
+            if measure == 'salton':
+                return numpy.where(product == 0.0, 0.0, isect / numpy.sqrt(product))
+            if measure == 'sorensen':
+                return numpy.where(product == 0.0, 0.0, (2 * isect) / product)
+            if measure == 'leicht_holme_newman':
+                return numpy.where(product == 0.0, 0.0, isect / product)
+            if measure == 'hub_promoted':
+                minimum = numpy.minimum(degree[row], degree[col])
+                return numpy.where(minimum == 0.0, 0.0, isect / minimum)
+            if measure == 'hub_depressed':
+                maximum = numpy.maximum(degree[row], degree[col])
+                return numpy.where(maximum == 0.0, 0.0, isect / maximum)
 
     def unweight(self, i, j):
         """ Calculates pairwise weight edge on a given graph. """
@@ -60,7 +492,7 @@ class Similarity(object):
     def get_common_neighbors(self, i, j):
         """ Calculates pairwise common neighbors similarity on a given unweighted graph. """
 
-        return self.adjlist[i].intersection(self.adjlist[j])
+        return self.common(i, j)
 
     def nmf_cosine(self, i, j):
         """ The similarity between two nodes is given by the cosine of the
@@ -75,21 +507,29 @@ class Similarity(object):
     def preferential_attachment(self, i, j):
         """ Calculates pairwise preferential attachment similarities on a given unweighted graph. """
 
-        return float(self.graph.degree(i)) * float(self.graph.degree(j))
+        self.refresh()
+        return self.degree[i] * self.degree[j]
 
     def common_neighbors(self, i, j):
         """ Calculates pairwise common neighbors similarity on a given unweighted graph. """
 
-        return len(self.adjlist[i].intersection(self.adjlist[j]))
+        return self.common_count(i, j)
 
     def newman_collaboration(self, i, j):
         """ Calculates pairwise Newman’s collaboration similarity """
 
-        _sum = 0.0
-        cn = self.adjlist[i].intersection(self.adjlist[j])
-        for z in cn:
-            _sum += 1 / (self.graph.strength(z) - 1)
-        return _sum
+        self.refresh()
+        cn = self.common(i, j)
+        return math.fsum(1 / (self.degree[z] - 1) for z in cn)
+
+    def common_weights(self, i, j):
+        """ Weights of the edges (i, z) and (j, z) of the common neighbors z, merging the sorted CSR rows """
+
+        graph = self.graph
+        row_i, row_j = slice(graph.indptr[i], graph.indptr[i + 1]), slice(graph.indptr[j], graph.indptr[j + 1])
+        _, index_i, index_j = numpy.intersect1d(
+            graph.indices[row_i], graph.indices[row_j], assume_unique=True, return_indices=True)
+        return graph.data[row_i][index_i], graph.data[row_j][index_j]
 
     def weighted_common_neighbors(self, i, j):
         """
@@ -97,11 +537,8 @@ class Similarity(object):
         on a given unweighted graph.
         """
 
-        _sum = 0.0
-        cn = self.adjlist[i].intersection(self.adjlist[j])
-        for z in cn:
-            _sum += (self.graph[i, z] + self.graph[j, z]) / 2
-        return _sum
+        weights_i, weights_j = self.common_weights(i, j)
+        return math.fsum(((weights_i + weights_j) / 2).tolist())
 
     def hops_common_neighbors(self, graph, hop, i, j):
         """ 
@@ -119,96 +556,136 @@ class Similarity(object):
             vertices=j, order=hop-1, mindist=1))
         return len(path_hops_i.intersection(path_hops_j))
 
+    def hops_pairs(self, graph, hop, rows, cols):
+        """ hops_common_neighbors of the given pairs (i, j), by the batch engine at two hops """
+
+        if hop == 2:
+            return self.score_pairs(rows, cols, 'weighted_common_neighbors')
+
+        # Common vertices of the (hop - 1)-balls, looked up from the end with
+        # the smallest ball among the sorted (vertex, reached) keys
+        self.evaluations += len(rows)
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        cols = numpy.asarray(cols, dtype=numpy.int64)
+        if len(rows) == 0:
+            return numpy.empty(0)
+        indptr, indices, keys = self.hop_balls(graph, hop - 1, numpy.union1d(rows, cols))
+        if len(keys) == 0:
+            return numpy.zeros(len(rows))
+        n = graph.vcount()
+        lengths = numpy.diff(indptr)
+        low = numpy.where(lengths[rows] <= lengths[cols], rows, cols)
+        high = numpy.where(lengths[rows] <= lengths[cols], cols, rows)
+        counts = lengths[low]
+        pair = numpy.repeat(numpy.arange(len(rows)), counts)
+        offsets = numpy.repeat(indptr[low] - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())
+        lookup = high[pair] * n + indices[offsets]
+        position = numpy.minimum(numpy.searchsorted(keys, lookup), len(keys) - 1)
+        found = keys[position] == lookup
+        return numpy.bincount(pair[found], minlength=len(rows)).astype(float)
+
+    def hop_balls(self, graph, order, vertices):
+        """
+        Vertices at 1 to order steps of each vertex of the layers of the given
+        vertices, as offset-encoded arrays over all vertices and sorted
+        (vertex, reached) keys, kept per order until the graph changes
+        """
+
+        self.refresh()
+        layers = set(numpy.unique(graph.type[vertices]).tolist())
+        if order not in self.balls or not layers <= self.balls[order][0]:
+            layers |= self.balls[order][0] if order in self.balls else set()
+            members = numpy.concatenate([graph['vertices_by_type'][layer] for layer in sorted(layers)])
+            members = numpy.sort(numpy.asarray(members, dtype=numpy.int64))
+            member_indptr, indices = graph.hop_index(members, order, 1)
+            counts = numpy.zeros(graph.vcount(), dtype=numpy.int64)
+            counts[members] = numpy.diff(member_indptr)
+            indptr = numpy.concatenate(([0], numpy.cumsum(counts)))
+            keys = numpy.sort(numpy.repeat(members, counts[members]) * graph.vcount() + indices)
+            self.balls[order] = (layers, indptr, indices, keys)
+        return self.balls[order][1:]
+
     def jaccard(self, i, j):
         """ Calculates pairwise jaccard similarity on a given unweighted graph. """
 
-        isect = len(self.adjlist[i].intersection(self.adjlist[j]))
-        union = (len(self.adjlist[i]) + len(self.adjlist[j]) - isect)
+        isect = self.common_count(i, j)
+        union = self.neighbor_count[i] + self.neighbor_count[j] - isect
         return 0 if union == 0 else isect / float(union)
 
     def weighted_jaccard(self, i, j):
         """ Calculates pairwise jaccard similarity on a given unweighted graph. """
 
-        _sum_isect = 0.0
-        isect = self.adjlist[i].intersection(self.adjlist[j])
-        for z in isect:
-            _sum_isect += (self.graph[i, z] + self.graph[j, z]) / 2
-
-        _sum_union = 0.0
-        union = self.adjlist[i].union(self.adjlist[j]) - isect
-        for z in union:
-            _sum_union += (self.graph[i, z] + self.graph[j, z]) / 2
-
+        weights_i, weights_j = self.common_weights(i, j)
+        _sum_isect = math.fsum(((weights_i + weights_j) / 2).tolist())
+        self.refresh()
+        _sum_union = (self.strength[i] + self.strength[j]) / 2 - _sum_isect
         return 0 if _sum_union == 0.0 else _sum_isect / _sum_union
 
     def salton(self, i, j):
         """ Calculates pairwise solton similarity on a given unweighted graph. """
 
-        product = float(self.graph.degree(i)) * float(self.graph.degree(j))
+        self.refresh()
+        product = self.degree[i] * self.degree[j]
         if product == 0.0:
             return 0.0
 
-        isect = len(self.adjlist[i].intersection(self.adjlist[j]))
+        isect = self.common_count(i, j)
         return isect / math.sqrt(product)
 
     def adamic_adar(self, i, j):
         """ Calculates pairwise adamic adar similarity on a given unweighted graph. """
 
-        score = 0.0
-        for isect in self.adjlist[i].intersection(self.adjlist[j]):
-            degree = self.graph.degree(isect)
-            if degree != 0:
-                score += 1 / math.log(degree)
-        return score
+        self.refresh()
+        return math.fsum(1 / self.log_degree[isect] for isect in self.common(i, j) if self.degree[isect] != 0)
 
     def resource_allocation(self, i, j):
         """ Calculates pairwise resource allocation similarity on a given unweighted graph. """
 
-        score = 0.0
-        for isect in self.adjlist[i].intersection(self.adjlist[j]):
-            degree = self.graph.degree(isect)
-            if degree != 0:
-                score += 1 / degree
-        return score
+        self.refresh()
+        return math.fsum(self.inverse_degree[isect] for isect in self.common(i, j) if self.degree[isect] != 0)
 
     def sorensen(self, i, j):
         """ Calculates pairwise sorensen similarity on a given unweighted graph. """
 
-        _sum = float(self.graph.degree(i)) * float(self.graph.degree(j))
+        self.refresh()
+        _sum = self.degree[i] * self.degree[j]
         if _sum == 0.0:
             return 0.0
 
-        isect = 2 * len(self.adjlist[i].intersection(self.adjlist[j]))
+        isect = 2 * self.common_count(i, j)
         return isect / _sum
 
     def hub_promoted(self, i, j):
         """ Calculates pairwise hub promoted similarity on a given unweighted graph. """
 
-        minimum = min(float(self.graph.degree(i)), float(self.graph.degree(j)))
+        self.refresh()
+        minimum = min(self.degree[i], self.degree[j])
         if minimum == 0.0:
             return 0.0
 
-        isect = len(self.adjlist[i].intersection(self.adjlist[j]))
+        isect = self.common_count(i, j)
         return isect / minimum
 
     def hub_depressed(self, i, j):
         """ Calculates pairwise hub depressed similarity on a given unweighted graph. """
 
-        maximum = max(float(self.graph.degree(i)), float(self.graph.degree(j)))
+        self.refresh()
+        maximum = max(self.degree[i], self.degree[j])
         if maximum == 0.0:
             return 0.0
 
-        isect = len(self.adjlist[i].intersection(self.adjlist[j]))
+        isect = self.common_count(i, j)
         return isect / maximum
 
     def leicht_holme_newman(self, i, j):
         """ Calculates pairwise leicht holmeNewman similarity on a given unweighted graph. """
 
-        product = float(self.graph.degree(i)) * float(self.graph.degree(j))
+        self.refresh()
+        product = self.degree[i] * self.degree[j]
         if product == 0.0:
             return 0.0
 
-        isect = len(self.adjlist[i].intersection(self.adjlist[j]))
+        isect = self.common_count(i, j)
         return isect / product
 
     def within_common_neighbors(self, i, j):
@@ -218,7 +695,7 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
-        isect = self.adjlist[i].intersection(self.adjlist[j])
+        isect = self.common(i, j)
         within_isect = 0.0
         for vertex in isect:
             if self.vs[vertex]['membership'] == self.vs[i]['membership']:
@@ -232,12 +709,12 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
-        isect = self.adjlist[i].intersection(self.adjlist[j])
+        isect = self.common(i, j)
         within_isect = 0.0
         for vertex in isect:
             if self.vs[vertex]['membership'] == self.vs[i]['membership']:
                 within_isect += 1.0
-        union = (len(self.adjlist[i]) + len(self.adjlist[j]) - within_isect)
+        union = self.neighbor_count[i] + self.neighbor_count[j] - within_isect
         return 0 if union == 0 else within_isect / float(union)
 
     def within_salton(self, i, j):
@@ -247,12 +724,13 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
-        product = float(self.graph.degree(i)) * float(self.graph.degree(j))
+        self.refresh()
+        product = self.degree[i] * self.degree[j]
 
         if product == 0.0:
             return 0.0
 
-        isect = self.adjlist[i].intersection(self.adjlist[j])
+        isect = self.common(i, j)
         within_isect = 0.0
         for vertex in isect:
             if self.vs[vertex]['membership'] == self.vs[i]['membership']:
@@ -266,12 +744,12 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
+        self.refresh()
         score = 0.0
-        for isect in self.adjlist[i].intersection(self.adjlist[j]):
+        for isect in self.common(i, j):
             if self.vs[isect]['membership'] == self.vs[i]['membership']:
-                degree = self.graph.degree(isect)
-                if degree != 0:
-                    score += 1 / math.log(degree)
+                if self.degree[isect] != 0:
+                    score += 1 / self.log_degree[isect]
         return score
 
     def within_resource_allocation(self, i, j):
@@ -281,12 +759,12 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
+        self.refresh()
         score = 0.0
-        for isect in self.adjlist[i].intersection(self.adjlist[j]):
+        for isect in self.common(i, j):
             if self.vs[isect]['membership'] == self.vs[i]['membership']:
-                degree = self.graph.degree(isect)
-                if degree != 0:
-                    score += 1 / degree
+                if self.degree[isect] != 0:
+                    score += self.inverse_degree[isect]
         return score
 
     def within_sorensen(self, i, j):
@@ -296,11 +774,12 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
-        _sum = float(self.graph.degree(i)) * float(self.graph.degree(j))
+        self.refresh()
+        _sum = self.degree[i] * self.degree[j]
         if _sum == 0.0:
             return 0.0
 
-        isect = self.adjlist[i].intersection(self.adjlist[j])
+        isect = self.common(i, j)
         within_isect = 0.0
         for vertex in isect:
             if self.vs[vertex]['membership'] == self.vs[i]['membership']:
@@ -314,11 +793,12 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
-        minimum = min(float(self.graph.degree(i)), float(self.graph.degree(j)))
+        self.refresh()
+        minimum = min(self.degree[i], self.degree[j])
         if minimum == 0.0:
             return 0.0
 
-        isect = self.adjlist[i].intersection(self.adjlist[j])
+        isect = self.common(i, j)
         within_isect = 0.0
         for vertex in isect:
             if self.vs[vertex]['membership'] == self.vs[i]['membership']:
@@ -332,11 +812,12 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
-        maximum = max(float(self.graph.degree(i)), float(self.graph.degree(j)))
+        self.refresh()
+        maximum = max(self.degree[i], self.degree[j])
         if maximum == 0.0:
             return 0.0
 
-        isect = self.adjlist[i].intersection(self.adjlist[j])
+        isect = self.common(i, j)
         within_isect = 0.0
         for vertex in isect:
             if self.vs[vertex]['membership'] == self.vs[i]['membership']:
@@ -350,11 +831,12 @@ class Similarity(object):
         common neighbors instead of the set of all common neighbors
         """
 
-        product = float(self.graph.degree(i)) * float(self.graph.degree(j))
+        self.refresh()
+        product = self.degree[i] * self.degree[j]
         if product == 0.0:
             return 0.0
 
-        isect = self.adjlist[i].intersection(self.adjlist[j])
+        isect = self.common(i, j)
         within_isect = 0.0
         for vertex in isect:
             if self.vs[vertex]['membership'] == self.vs[i]['membership']:
@@ -368,7 +850,7 @@ class Similarity(object):
         neighbors of these vertices.
         """
 
-        isect = self.adjlist[i].intersection(self.adjlist[j])
+        isect = self.common(i, j)
         nWcn = 0.0  # Intra cluster or intra community
         nIcn = 0.0  # Inter clusters or inter comunities
         for vertex in isect:
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic k-partite graphs with planted communities
+
+Copyright (C) 2020 Alan Valejo <alanvalejo@gmail.com> All rights reserved
+
+This program comes with ABSOLUTELY NO WARRANTY. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS
+WITH YOU.
+
+Owner or contributors are not liable for any direct, indirect, incidental, special, exemplary, or consequential
+damages, (such as loss of data or profits, and others) arising in any way out of the use of this software,
+even if advised of the possibility of such damage.
+
+This program is free software and distributed in the hope that it will be useful: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with this program. If not,
+see http://www.gnu.org/licenses/.
+
+Giving credit to the author by citing the papers.
+"""
+
+
+import numpy
+
+from models import export
+
+__maintainer__ = 'Alan Valejo'
+__email__ = 'alanvalejo@gmail.com'
+__author__ = 'Alan Valejo'
+__credits__ = ['Alan Valejo']
+__homepage__ = 'https://www.alanvalejo.com.br'
+__license__ = 'GNU.GPL.v3'
+__docformat__ = 'markdown en'
+__version__ = '0.1'
+__date__ = '2020-05-05'
+
+
+def power_law_weights(n, exponent, random):
+    """ Expected degrees of n vertices following a power law P(k) ~ k^-exponent """
+
+    ranks = random.permutation(n) + 1.0
+    return ranks ** (-1.0 / (exponent - 1.0))
+
+
+def sample(cumulative, starts, totals, random):
+    """ One position per (start, total) drawn proportionally to the weights """
+
+    targets = cumulative[starts] + random.random_sample(len(starts)) * totals
+    return numpy.minimum(numpy.searchsorted(cumulative, targets, side='right') - 1, len(cumulative) - 2)
+
+
+def kpartite(vertices, edges, communities=10, mixing=0.1, exponent=2.5, seed=0):
+    """
+    BNOC-like k-partite graph: the vertices of each layer are split into
+    `communities` planted communities and about `edges` edges link
+    consecutive layers. An edge starts at a vertex drawn by its power-law
+    weight and ends at a vertex of the same community of the next layer or,
+    with probability mixing, of any community, also drawn by weight.
+    Returns the unique edges (in global vertex ids), their multiplicities as
+    weights, and the community of every vertex.
+    """
+
+    random = numpy.random.RandomState(seed)
+    vertices = list(vertices)
+    membership = numpy.concatenate([random.randint(0, communities, n) for n in vertices])
+    weights = numpy.concatenate([power_law_weights(n, exponent, random) for n in vertices])
+
+    # Vertices sorted by (layer, community), with cumulative weights, so that
+    # a layer or one of its communities is a contiguous range to sample from
+    layer = numpy.repeat(numpy.arange(len(vertices)), vertices)
+    order = numpy.lexsort((membership, layer))
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(weights[order])))
+    groups = layer[order] * communities + membership[order]
+    bounds = numpy.searchsorted(groups, numpy.arange(len(vertices) * communities + 1))
+
+    pairs = list(zip(range(len(vertices) - 1), range(1, len(vertices))))
+    result = []
+    for (a, b), count in zip(pairs, numpy.diff(numpy.linspace(0, edges, len(pairs) + 1).astype(numpy.int64))):
+        u = order[sample(cumulative, numpy.full(count, bounds[a * communities]),
+                         cumulative[bounds[(a + 1) * communities]] - cumulative[bounds[a * communities]], random)]
+        community = numpy.where(random.random_sample(count) < mixing,
+                                random.randint(0, communities, count), membership[u])
+        first, last = bounds[b * communities + community], bounds[b * communities + community + 1]
+        valid = last > first
+        v = order[sample(cumulative, first[valid], cumulative[last[valid]] - cumulative[first[valid]], random)]
+        result.append(numpy.column_stack((u[valid], v)))
+
+    result = numpy.concatenate(result) if result else numpy.empty((0, 2), dtype=numpy.int64)
+    unique, counts = numpy.unique(result, axis=0, return_counts=True)
+    return unique, counts, membership
+
+
+def write_ncol(filename, edges, weights):
+    """ Write the edges as an ncol file (u v weight) """
+
+    rows = numpy.column_stack((edges, weights)).astype(numpy.int64)
+    export.write_rows(filename, numpy.arange(0, rows.size + 1, 3), rows.ravel())
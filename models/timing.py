@@ -24,12 +24,19 @@ see http://www.gnu.org/licenses/.
 Giving credit to the author by citing the papers.
 """
 
+import os
+import sys
 import time
 import csv
 import json
 
 from contextlib import contextmanager
 
+try:
+	import resource
+except ImportError:  # not available on Windows
+	resource = None
+
 __maintainer__ = 'Alan Valejo'
 __email__ = 'alanvalejo@gmail.com'
 __author__ = 'Alan Valejo'
@@ -50,13 +57,20 @@ class Timing(object):
 		mike.think()
 		timing.add_elapsed()
 		timing.print_tabular()
+
+	Nested spans record a tree, e.g., per level and per layer:
+		with timing.span('Level 1', hop=2):
+			with timing.span('Matching'):
+				timing.count(evaluations=100)
 	"""
 
 	def __init__(self, header=[], rows=[]):
 		self.start = 0
 		self.header = header
-		self.rows = rows
+		self.rows = list(rows)
 		self.elapsed_set = []
+		self.spans = []
+		self.stack = []
 
 	def get_now(self):
 		self.start = time.time()
@@ -72,6 +86,11 @@ class Timing(object):
 		print(row_format.format(*self.header))
 		for row, item in zip(self.rows, self.elapsed_set):
 			print(row_format.format(row, *item))
+		if any(span['children'] for span in self.spans):
+			print()
+			for depth, path, span in self.walk():
+				counters = ', '.join('%s %s' % item for item in sorted(span['counters'].items()))
+				print('%s%s: %.4f s %s' % ('  ' * depth, span['name'], span['end'] - span['start'], counters))
 
 	def save_csv(self, output):
 		with open(output, 'w+') as csvfile:
@@ -79,13 +98,35 @@ class Timing(object):
 			writer.writerow(self.header)
 			for row, item in zip(self.rows, self.elapsed_set):
 				writer.writerow([row] + item)
+			if self.spans:
+				# Span tree, one row per span in depth-first order
+				keys = sorted(set(key for _, _, span in self.walk() for key in span['counters']))
+				writer.writerow([])
+				writer.writerow(['Span', 'Depth', 'Time [s]'] + keys)
+				for depth, path, span in self.walk():
+					writer.writerow([path, depth, '%.4f' % (span['end'] - span['start'])] +
+									[span['counters'].get(key, '') for key in keys])
 
 	def save_json(self, output):
 		dictionary = dict(zip(self.rows, self.elapsed_set))
 		dictionary['header'] = self.header
+		if self.spans:
+			dictionary['spans'] = [self.tree(span) for span in self.spans]
 		with open(output, 'w+') as jsonfile:
 			json.dump(dictionary, jsonfile, indent=4)
 
+	def save_trace(self, output):
+		""" Spans in the Chrome trace event format (chrome://tracing, Perfetto) """
+
+		origin = min([span['start'] for _, _, span in self.walk()] or [0])
+		events = [{
+			'name': span['name'], 'ph': 'X', 'pid': span['pid'], 'tid': 0,
+			'ts': (span['start'] - origin) * 1e6, 'dur': (span['end'] - span['start']) * 1e6,
+			'args': span['counters']
+		} for _, _, span in self.walk()]
+		with open(output, 'w+') as jsonfile:
+			json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, jsonfile)
+
 	def get_array(self):
 		return self.elapsed_set
 
@@ -107,7 +148,66 @@ class Timing(object):
 		"""
 
 		start = time.time()
-		yield
+		with self.span(name):
+			yield
 		elapsed = time.time() - start
 		self.rows.append(name)
 		self.elapsed_set.append([elapsed // 60, '%.4f' % (elapsed % 60)])
+
+	@contextmanager
+	def span(self, name, **counters):
+		"""
+		Span nested in the innermost open one. Counters are given here or
+		added by count while it is open; the peak RSS of the process is
+		recorded when it is closed.
+		"""
+
+		span = dict(name=name, start=time.time(), end=None, pid=os.getpid(), counters=counters, children=[])
+		(self.stack[-1]['children'] if self.stack else self.spans).append(span)
+		self.stack.append(span)
+		try:
+			yield span
+		finally:
+			self.stack.pop()
+			span['end'] = time.time()
+			if resource is not None:
+				span['counters']['peak_rss'] = peak_rss()
+
+	def add_span(self, name, start, end, pid=None, **counters):
+		""" Span measured elsewhere, e.g., in a worker process, as a child of the innermost open one """
+
+		span = dict(name=name, start=start, end=end, pid=pid or os.getpid(), counters=counters, children=[])
+		(self.stack[-1]['children'] if self.stack else self.spans).append(span)
+		return span
+
+	def count(self, **counters):
+		""" Add to the counters of the innermost open span """
+
+		if self.stack:
+			span_counters = self.stack[-1]['counters']
+			for key, value in counters.items():
+				span_counters[key] = span_counters.get(key, 0) + value
+
+	def walk(self, spans=None, depth=0, prefix=''):
+		""" (depth, path, span) of every span, depth first """
+
+		for span in self.spans if spans is None else spans:
+			path = prefix + span['name']
+			yield depth, path, span
+			for item in self.walk(span['children'], depth + 1, path + '/'):
+				yield item
+
+	def tree(self, span):
+		return {
+			'name': span['name'], 'time': span['end'] - span['start'], 'pid': span['pid'],
+			'counters': span['counters'], 'children': [self.tree(child) for child in span['children']]
+		}
+
+
+def peak_rss():
+	""" Peak resident set size of the process in MB (ru_maxrss is in KB on Linux, in bytes on macOS) """
+
+	if resource is None:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return round(rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)